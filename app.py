@@ -1,4 +1,5 @@
 import os
+import sys
 import sqlite3
 import hashlib
 import secrets
@@ -10,17 +11,33 @@ import ssl
 import random
 import string
 import base64
+import re
+import math
 import traceback
+import time
+import threading
+import mimetypes
+import subprocess
+import zipfile
+import click
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode, urlsplit
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from email import encoders
 from functools import wraps
 from flask import (
     Flask, render_template, request, redirect, url_for,
     session, flash, jsonify, send_file, g, make_response,
-    send_from_directory
+    send_from_directory, Response, stream_with_context, abort,
+    has_request_context, before_render_template, template_rendered, got_request_exception
 )
-from werkzeug.utils import secure_filename
+from markupsafe import Markup, escape
+from werkzeug.security import safe_join
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
@@ -42,6 +59,11 @@ os.makedirs(AVATAR_UPLOAD_FOLDER, exist_ok=True)
 app.config['AVATAR_UPLOAD_FOLDER'] = AVATAR_UPLOAD_FOLDER
 
 ALLOWED_AVATAR_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+AVATAR_MAX_AGE = 31536000  # avatar names are content hashes, so a URL never changes meaning
+# Optional front-proxy offload of avatar files only: nginx `internal` location prefix, or X-Sendfile
+# (Apache/lighttpd). Other send_file responses (certificates, exports) are unaffected.
+AVATAR_ACCEL_PREFIX = os.environ.get('AVATAR_ACCEL_PREFIX', '')
+AVATAR_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '0') == '1'
 
 # ─────────── MANAGER SIGNATURE CONFIG ───────────
 MANAGERS = {
@@ -95,14 +117,85 @@ SMTP_USER = os.environ.get('SMTP_USER', '')
 SMTP_PASS = os.environ.get('SMTP_PASS', '')
 SMTP_FROM = os.environ.get('SMTP_FROM', '') or os.environ.get('SMTP_USER', '')
 
+# ─────────── EMAIL OUTBOX CONFIG ───────────
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_BASE = 60      # seconds; doubled after every failed attempt
+OUTBOX_RETRY_CAP = 3600     # never wait more than 1h between retries
+OUTBOX_LEASE = 300          # a 'sending' row older than this was abandoned by a dead worker
+
+# ─────────── HR SYNC ───────────
+HR_SYNC_TOKEN = os.environ.get('HR_SYNC_TOKEN', '')  # Bearer token for /admin/api/results/changes
+
+# ─────────── CONTENT CACHE CONFIG ───────────
+CONTENT_CACHE_SIZE = int(os.environ.get('CONTENT_CACHE_SIZE', '512'))  # entries per worker process
+
+# ─────────── REQUEST TIMING CONFIG ───────────
+# Opt-in: SQL, template and email time per request in a Server-Timing header; slow requests are logged.
+REQUEST_TIMING = os.environ.get('REQUEST_TIMING', '0') == '1'
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', '500'))
+SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG', '')  # JSON lines file; empty = print [SLOW] lines
+
+# ─────────── METRICS CONFIG ───────────
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # Bearer token for /metrics; unset = metrics off
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'metrics'))
+METRICS_FLUSH_SECONDS = 5   # how stale another worker's numbers may be in a scrape
+app.config['SQL_TRACE'] = REQUEST_TIMING or bool(METRICS_TOKEN)
+
 
 # ─────────── DATABASE ───────────
+SQLITE_INTERNAL_SQL = re.compile(r"PRAGMA '\w+'\.data_version$|SELECT k, v FROM '\w+'\.'\w+_config'$")
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection that records every statement SQLite runs, through its trace callback.
+
+    Each entry is [sql, seconds]; the time is what the execute()/executemany() call that started
+    the statement took, so rows fetched later through the cursor are not included.
+    """
+    statements = ()
+    _call_start = None
+
+    def start_trace(self):
+        self.statements = []
+        self.set_trace_callback(self._trace)
+
+    def _trace(self, sql):
+        # Statements SQLite runs on its own behalf are skipped: FTS5 reads its config and data_version
+        # with plain statements and everything else as "-- ..." comments; trigger bodies come again
+        # under the text of the statement that fired them.
+        if sql.startswith('--') or SQLITE_INTERNAL_SQL.match(sql) or (
+                self._call_start is not None and len(self.statements) > self._call_start
+                and self.statements[-1][0] == sql):
+            return
+        self.statements.append([sql, 0.0])
+
+    def _timed(self, method, *args):
+        self._call_start = seen = len(self.statements)
+        t0 = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._call_start = None
+            if len(self.statements) > seen:
+                self.statements[-1][1] += time.perf_counter() - t0
+
+    def execute(self, *args):
+        return self._timed(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, *args)
+
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
+        # Only request connections are traced: CLI workers keep theirs open for their whole life.
+        traced = app.config.get('SQL_TRACE', False) and has_request_context()
+        g.db = sqlite3.connect(DATABASE, factory=TracedConnection if traced else sqlite3.Connection)
         g.db.row_factory = sqlite3.Row
         g.db.execute("PRAGMA journal_mode=WAL")
         g.db.execute("PRAGMA foreign_keys=ON")
+        if traced:
+            g.db.start_trace()
     return g.db
 
 @app.teardown_appcontext
@@ -112,16 +205,300 @@ def close_db(exc):
         db.close()
 
 
-def get_allowed_emails():
-    """Get whitelist from DB, fallback to defaults."""
+# ─────────── REQUEST TIMING ───────────
+# Only registered when REQUEST_TIMING is on; otherwise the sole cost is the flag check in record_timing.
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_IN_LIST = re.compile(r"\(\?(?:, \?)+\)")
+
+
+def normalize_sql(sql):
+    """Statement text with literals replaced by ?, so repeats of one query group together."""
+    return SQL_IN_LIST.sub('(?, ...)', SQL_LITERAL.sub('?', ' '.join(sql.split())))
+
+
+def record_timing(name, seconds):
+    """Add to one of the current request's timing buckets ('tpl', 'email')."""
+    if REQUEST_TIMING and has_request_context() and 'timing' in g:
+        g.timing[name] = g.timing.get(name, 0.0) + seconds
+
+
+def start_request_timing():
+    db = g.get('db')
+    g.timing = {'start': time.perf_counter(), 'sql_from': len(getattr(db, 'statements', ())), 'tpl_started': []}
+
+
+def template_started(sender, **extra):
+    if 'timing' in g:
+        g.timing['tpl_started'].append(time.perf_counter())
+
+
+def template_finished(sender, **extra):
+    if 'timing' in g and g.timing['tpl_started']:
+        record_timing('tpl', time.perf_counter() - g.timing['tpl_started'].pop())
+
+
+def finish_request_timing(response):
+    """Set Server-Timing and log the request if it took longer than SLOW_REQUEST_MS.
+
+    Streamed responses (CSV/ZIP exports) are measured up to the first byte only.
+    """
+    timing = g.pop('timing', None)
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing['start']
+    statements = list(getattr(g.get('db'), 'statements', ()))[timing['sql_from']:]
+    sql = sum(seconds for _, seconds in statements)
+    parts = [('sql', sql, f'{len(statements)} queries'), ('tpl', timing.get('tpl', 0.0), 'templates'),
+             ('email', timing.get('email', 0.0), 'send_email'), ('total', total, None)]
+    response.headers['Server-Timing'] = ', '.join(
+        f'{name};dur={seconds * 1000:.1f}' + (f';desc="{desc}"' if desc else '') for name, seconds, desc in parts)
+    if total * 1000 >= SLOW_REQUEST_MS:
+        log_slow_request(response, total, sql, timing, statements)
+    return response
+
+
+def log_slow_request(response, total, sql, timing, statements):
+    queries = {}
+    for text, seconds in statements:
+        entry = queries.setdefault(normalize_sql(text), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+    record = {
+        'at': datetime.now().isoformat(timespec='seconds'), 'method': request.method, 'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint, 'status': response.status_code, 'total_ms': round(total * 1000, 1),
+        'sql_ms': round(sql * 1000, 1), 'sql_count': len(statements),
+        'tpl_ms': round(timing.get('tpl', 0.0) * 1000, 1), 'email_ms': round(timing.get('email', 0.0) * 1000, 1),
+        'queries': [{'sql': text, 'count': count, 'ms': round(seconds * 1000, 2)}
+                    for text, (count, seconds) in sorted(queries.items(), key=lambda q: -q[1][1])[:20]],
+    }
+    line = json.dumps(record, ensure_ascii=False)
+    if SLOW_REQUEST_LOG:
+        with open(SLOW_REQUEST_LOG, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    else:
+        print(f"[SLOW] {line}")
+
+
+if REQUEST_TIMING:
+    app.before_request(start_request_timing)
+    app.after_request(finish_request_timing)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+
+
+# ─────────── METRICS ───────────
+# Each process counts in memory and snapshots its totals to METRICS_DIR/<pid>.json at most every
+# METRICS_FLUSH_SECONDS; /metrics adds up every snapshot, so all gunicorn workers (and the outbox
+# worker) are reported together. Snapshots of exited processes are folded into retired.json so
+# counters never go back.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    'lms_http_request_duration_seconds': ('histogram', 'Request latency per Flask endpoint.'),
+    'lms_http_requests_total': ('counter', 'Requests per endpoint and status code.'),
+    'lms_sqlite_queries_total': ('counter', 'SQL statements run while serving requests, per endpoint.'),
+    'lms_sqlite_busy_total': ('counter', 'Requests that failed with SQLITE_BUSY / SQLITE_LOCKED.'),
+    'lms_emails_total': ('counter', 'Emails handed to SMTP, by transport and outcome.'),
+    'lms_quiz_submissions_total': ('counter', 'Quiz submissions.'),
+}
+
+
+class Metrics:
+    """Counters and histograms of this process, keyed by (name, labels)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # key -> [count per bucket..., count above the last bucket, sum]
+        self.flushed_at = 0.0
+        self.pid = None
+
+    @property
+    def snapshot_name(self):
+        # pid plus a random suffix: a later process that gets the same pid must not overwrite
+        # this one's totals. A fork (gunicorn --preload) starts over with a name of its own.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.name = f'{self.pid}-{secrets.token_hex(4)}.json'
+        return self.name
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            h[next((i for i, b in enumerate(LATENCY_BUCKETS) if seconds <= b), len(LATENCY_BUCKETS))] += 1
+            h[-1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return metrics_snapshot(self.counters, self.histograms)
+
+    def flush(self, force=False):
+        if not force and time.monotonic() - self.flushed_at < METRICS_FLUSH_SECONDS:
+            return
+        self.flushed_at = time.monotonic()
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            write_metrics_file(os.path.join(METRICS_DIR, self.snapshot_name), self.snapshot())
+            retire_metrics_snapshots()
+        except OSError as e:
+            print(f"[METRICS] snapshot failed: {e}")
+
+
+def metrics_snapshot(counters, histograms):
+    return {'counters': [[n, list(map(list, l)), v] for (n, l), v in counters.items()],
+            'histograms': [[n, list(map(list, l)), h] for (n, l), h in histograms.items()]}
+
+
+def merge_metrics(snapshots):
+    """Snapshots added up: (counters, histograms) keyed like Metrics."""
+    counters, histograms = {}, {}
+    for snap in snapshots:
+        for name, labels, value in snap['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, h in snap['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            histograms[key] = [a + b for a, b in zip(histograms[key], h)] if key in histograms else list(h)
+    return counters, histograms
+
+
+def read_metrics_file(path):
     try:
-        db = get_db()
-        rows = db.execute("SELECT email FROM allowed_emails WHERE active=1").fetchall()
-        if rows:
-            return [r['email'].lower() for r in rows]
-    except Exception:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_metrics_file(path, snapshot):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
         pass
-    return [e.lower() for e in DEFAULT_EMAILS]
+    return True
+
+
+def retire_metrics_snapshots():
+    """Fold the snapshots of exited processes into retired.json, so the directory stays small
+    and their totals still count. Runs under a file lock so two workers never fold one twice."""
+    import fcntl
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = [name for name in os.listdir(METRICS_DIR)
+                if name.endswith('.json') and name != 'retired.json'
+                and name.split('-', 1)[0].isdigit() and not process_alive(int(name.split('-', 1)[0]))]
+        if not dead:
+            return
+        retired_path = os.path.join(METRICS_DIR, 'retired.json')
+        snapshots = [read_metrics_file(retired_path) or {'counters': [], 'histograms': []}]
+        snapshots += filter(None, (read_metrics_file(os.path.join(METRICS_DIR, name)) for name in dead))
+        write_metrics_file(retired_path, metrics_snapshot(*merge_metrics(snapshots)))
+        for name in dead:
+            os.remove(os.path.join(METRICS_DIR, name))
+
+
+metrics = Metrics()
+
+
+def count_metric(name, labels=(), value=1):
+    if METRICS_TOKEN:
+        metrics.inc(name, labels, value)
+
+
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.metrics_sql_from = len(getattr(g.get('db'), 'statements', ()))
+
+
+def finish_request_metrics(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    metrics.observe('lms_http_request_duration_seconds', (('endpoint', endpoint),), time.perf_counter() - start)
+    metrics.inc('lms_http_requests_total', (('endpoint', endpoint), ('status', str(response.status_code))))
+    queries = len(getattr(g.get('db'), 'statements', ())) - g.pop('metrics_sql_from', 0)
+    if queries > 0:
+        metrics.inc('lms_sqlite_queries_total', (('endpoint', endpoint),), queries)
+    metrics.flush()
+    return response
+
+
+def count_sqlite_busy(sender, exception, **extra):
+    if getattr(exception, 'sqlite_errorname', '').startswith(('SQLITE_BUSY', 'SQLITE_LOCKED')):
+        metrics.inc('lms_sqlite_busy_total', (('endpoint', request.endpoint or 'unmatched'),))
+
+
+def collect_metrics():
+    """Every process's totals added up, including retired.json: (counters, histograms)."""
+    own = metrics.snapshot_name
+    snapshots = [metrics.snapshot()]
+    for name in os.listdir(METRICS_DIR) if os.path.isdir(METRICS_DIR) else ():
+        if name.endswith('.json') and name != own:
+            snapshots.append(read_metrics_file(os.path.join(METRICS_DIR, name)))
+    return merge_metrics(filter(None, snapshots))
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escape_value = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape_value(v)}"' for k, v in labels) + '}'
+
+
+def render_metrics(counters, histograms, gauges):
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        if kind == 'histogram':
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, h):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{prometheus_labels(labels + (("le", bound),))} {cumulative}')
+                cumulative += h[len(LATENCY_BUCKETS)]
+                lines.append(f'{name}_bucket{prometheus_labels(labels + (("le", "+Inf"),))} {cumulative}')
+                lines.append(f'{name}_sum{prometheus_labels(labels)} {h[-1]:.6f}')
+                lines.append(f'{name}_count{prometheus_labels(labels)} {cumulative}')
+        else:
+            lines += [f'{name}{prometheus_labels(labels)} {value}'
+                      for (n, labels), value in sorted(counters.items()) if n == name]
+    for name, help_text, value in gauges:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+if METRICS_TOKEN:
+    app.before_request(start_request_metrics)
+    app.after_request(finish_request_metrics)
+    got_request_exception.connect(count_sqlite_busy, app)
+
+
+def is_email_allowed(email):
+    """Whitelist check by point lookup on allowed_emails.email; defaults apply while the list is empty."""
+    db = get_db()
+    if db.execute("SELECT 1 FROM allowed_emails WHERE email=? AND active=1", (email,)).fetchone():
+        return True
+    if db.execute("SELECT 1 FROM allowed_emails WHERE active=1 LIMIT 1").fetchone():
+        return False
+    return email in (e.lower() for e in DEFAULT_EMAILS)
 
 
 def allowed_avatar_file(filename):
@@ -136,11 +513,23 @@ def get_manager_for_department(dept):
     return MANAGERS.get(dept or "")
 
 
-def init_db():
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
+# ─────────── SCHEMA MIGRATIONS ───────────
+# Each migration runs exactly once; the applied version is kept in PRAGMA user_version.
+# Never edit a shipped migration — append a new one.
+def run_script(db, script):
+    """Run a multi-statement script inside the current transaction (executescript would COMMIT)."""
+    stmt = ''
+    for part in script.split(';'):
+        stmt += part + ';'
+        if sqlite3.complete_statement(stmt):  # keeps trigger bodies (BEGIN ... END) together
+            if stmt.strip(' \n;'):
+                db.execute(stmt)
+            stmt = ''
+
 
-    db.executescript('''
+def migrate_001_base(db):
+    """Baseline schema, legacy column upgrades and seed data."""
+    run_script(db, '''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
@@ -208,9 +597,20 @@ def init_db():
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY, value TEXT
         );
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_email TEXT NOT NULL, subject TEXT NOT NULL, html_body TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0, max_attempts INTEGER DEFAULT 6,
+            last_error TEXT,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON email_outbox(status, next_attempt_at);
     ''')
 
-    # ── Migration: add new columns safely ──
+    # ── Databases created before v2.0: add new columns safely ──
     def add_col(table, col, typedef):
         cols = [r[1] for r in db.execute(f"PRAGMA table_info({table})").fetchall()]
         if col not in cols:
@@ -278,8 +678,528 @@ def init_db():
             db.execute("INSERT INTO questions (course_id,text,option_a,option_b,option_c,option_d,answer,explanation,source) VALUES (?,?,?,?,?,?,?,?,?)",
                        (cid, *q, "sample"))
 
+
+def migrate_002_indexes(db):
+    """Secondary indexes for the lookups the routes run on every request."""
+    run_script(db, '''
+        CREATE INDEX IF NOT EXISTS idx_results_user_course ON results(user_email, course_id, is_valid);
+        CREATE INDEX IF NOT EXISTS idx_results_course ON results(course_id, is_valid);
+        CREATE INDEX IF NOT EXISTS idx_results_completed ON results(completed_at);
+        CREATE INDEX IF NOT EXISTS idx_questions_course ON questions(course_id);
+        CREATE INDEX IF NOT EXISTS idx_retest_course ON retest_requests(course_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_courses_category ON courses(category, created_at);
+        CREATE INDEX IF NOT EXISTS idx_courses_created ON courses(created_at);
+        CREATE INDEX IF NOT EXISTS idx_users_department ON users(department, status);
+        CREATE INDEX IF NOT EXISTS idx_users_team ON users(team, status);
+        CREATE INDEX IF NOT EXISTS idx_users_status ON users(status, role);
+    ''')
+
+
+def migrate_003_question_count(db):
+    """courses.question_count, kept current by triggers on questions."""
+    db.execute("ALTER TABLE courses ADD COLUMN question_count INTEGER NOT NULL DEFAULT 0")
+    run_script(db, '''
+        UPDATE courses SET question_count=(SELECT COUNT(*) FROM questions q WHERE q.course_id=courses.id);
+        CREATE TRIGGER IF NOT EXISTS trg_questions_count_ins AFTER INSERT ON questions BEGIN
+            UPDATE courses SET question_count=question_count+1 WHERE id=NEW.course_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_questions_count_del AFTER DELETE ON questions BEGIN
+            UPDATE courses SET question_count=question_count-1 WHERE id=OLD.course_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_questions_count_move AFTER UPDATE OF course_id ON questions
+        WHEN NEW.course_id IS NOT OLD.course_id BEGIN
+            UPDATE courses SET question_count=question_count-1 WHERE id=OLD.course_id;
+            UPDATE courses SET question_count=question_count+1 WHERE id=NEW.course_id;
+        END;
+    ''')
+
+
+
+def migrate_004_course_targets(db):
+    """Normalized course targeting; courses.target_groups stays as a JSON mirror for display."""
+    run_script(db, '''
+        CREATE TABLE IF NOT EXISTS course_targets (
+            course_id INTEGER NOT NULL,
+            target_type TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (course_id, target_type, value),
+            FOREIGN KEY (course_id) REFERENCES courses(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_course_targets_lookup ON course_targets(target_type, value, course_id);
+    ''')
+    for c in db.execute("SELECT id, target_groups FROM courses").fetchall():
+        try: groups = json.loads(c['target_groups'] or '[]')
+        except ValueError: groups = []
+        db.executemany("INSERT OR IGNORE INTO course_targets (course_id,target_type,value) VALUES (?,?,?)",
+                       [(c['id'], 'department', grp) for grp in groups if grp])
+
+
+
+def migrate_005_search_index(db):
+    """FTS5 indexes over course text and question text, synced by triggers.
+
+    unicode61 with remove_diacritics 2 makes "an toan" match "An toàn"; the letter
+    đ has no decomposition, so build_fts_query() expands d/đ at query time.
+    """
+    run_script(db, '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS course_fts USING fts5(
+            title_vi, title_en, desc_vi, desc_en,
+            content='courses', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS question_fts USING fts5(
+            text, course_id UNINDEXED,
+            content='questions', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_course_fts_ins AFTER INSERT ON courses BEGIN
+            INSERT INTO course_fts(rowid, title_vi, title_en, desc_vi, desc_en)
+            VALUES (NEW.id, NEW.title_vi, NEW.title_en, NEW.desc_vi, NEW.desc_en);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_course_fts_del AFTER DELETE ON courses BEGIN
+            INSERT INTO course_fts(course_fts, rowid, title_vi, title_en, desc_vi, desc_en)
+            VALUES ('delete', OLD.id, OLD.title_vi, OLD.title_en, OLD.desc_vi, OLD.desc_en);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_course_fts_upd AFTER UPDATE OF title_vi, title_en, desc_vi, desc_en ON courses BEGIN
+            INSERT INTO course_fts(course_fts, rowid, title_vi, title_en, desc_vi, desc_en)
+            VALUES ('delete', OLD.id, OLD.title_vi, OLD.title_en, OLD.desc_vi, OLD.desc_en);
+            INSERT INTO course_fts(rowid, title_vi, title_en, desc_vi, desc_en)
+            VALUES (NEW.id, NEW.title_vi, NEW.title_en, NEW.desc_vi, NEW.desc_en);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_question_fts_ins AFTER INSERT ON questions BEGIN
+            INSERT INTO question_fts(rowid, text, course_id) VALUES (NEW.id, NEW.text, NEW.course_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_question_fts_del AFTER DELETE ON questions BEGIN
+            INSERT INTO question_fts(question_fts, rowid, text, course_id) VALUES ('delete', OLD.id, OLD.text, OLD.course_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_question_fts_upd AFTER UPDATE OF text, course_id ON questions BEGIN
+            INSERT INTO question_fts(question_fts, rowid, text, course_id) VALUES ('delete', OLD.id, OLD.text, OLD.course_id);
+            INSERT INTO question_fts(rowid, text, course_id) VALUES (NEW.id, NEW.text, NEW.course_id);
+        END;
+        INSERT INTO course_fts(course_fts) VALUES ('rebuild');
+        INSERT INTO question_fts(question_fts) VALUES ('rebuild');
+    ''')
+
+
+
+def migrate_006_content_version(db):
+    """settings.content_version, bumped by triggers on every course/question/target change."""
+    db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('content_version', '0')")
+    bump = "UPDATE settings SET value=CAST(value AS INTEGER)+1 WHERE key='content_version';"
+    for table in ('courses', 'questions', 'course_targets'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} "
+                       f"AFTER {event} ON {table} BEGIN {bump} END")
+
+
+
+def stats_keys(row):
+    """Rollup (dim, key) SQL pairs of a results row: NEW/OLD inside a trigger, or a table alias."""
+    return [
+        ("'all'", "''"),
+        ("'course'", f"CAST({row}.course_id AS TEXT)"),
+        ("'department'", f"COALESCE({row}.department, '')"),
+        ("'team'", f"COALESCE({row}.team, '')"),
+        ("'day'", f"date({row}.completed_at)"),
+    ]
+
+
+# stats_user_course columns holding the department/team/day keys of the pass a certificate is credited to.
+CERT_COLUMNS = ('cert_department', 'cert_team', 'cert_day')
+
+
+def cert_values(row):
+    """The CERT_COLUMNS values of a results row."""
+    return [key for _, key in stats_keys(row)[2:]]
+
+
+def cert_keys(where):
+    """SELECT of the rollup (dim, key) pairs credited with the certificates of the matching stats_user_course rows."""
+    keys = stats_keys('s')[:2] + [(dim, f's.{col}') for (dim, _), col in zip(stats_keys('s')[2:], CERT_COLUMNS)]
+    return ' UNION ALL '.join(f"SELECT {dim} AS dim, {key} AS key FROM stats_user_course s WHERE {where}"
+                              for dim, key in keys)
+
+
+def stats_trigger_body(row, sign):
+    """SQL that adds (sign='+') or removes (sign='-') one valid result `row` (NEW or OLD) from the rollups.
+
+    A certificate is one (user, course) pair with at least one valid pass. It is credited to the
+    dimensions of the pair's first valid pass (lowest id), which stats_user_course remembers, so
+    removing a pass debits exactly what was credited and hands the certificate to the next pass.
+    """
+    values = ',\n'.join(f"({dim}, {key}, {sign}1, {sign}{row}.passed)" for dim, key in stats_keys(row))
+    pair = f"s.user_email={row}.user_email AND s.course_id={row}.course_id"
+    own = f"user_email={row}.user_email AND course_id={row}.course_id"
+    cert_set = ', '.join(f'{col}={value}' for col, value in zip(CERT_COLUMNS, cert_values(row)))
+    if sign == '+':
+        # a pass older than the credited one (re-validated) takes the certificate over
+        certs = f"""
+            UPDATE stats_rollup SET certs=certs-1 WHERE {row}.passed=1
+                AND (dim, key) IN ({cert_keys(f"{pair} AND s.cert_result_id > {row}.id")});
+            INSERT INTO stats_user_course (user_email, course_id, passes)
+                SELECT {row}.user_email, {row}.course_id, 1 WHERE {row}.passed=1
+                ON CONFLICT(user_email, course_id) DO UPDATE SET passes=passes+1;
+            UPDATE stats_user_course SET cert_result_id={row}.id, {cert_set}
+                WHERE {row}.passed=1 AND {own} AND (cert_result_id IS NULL OR cert_result_id > {row}.id);
+            UPDATE stats_rollup SET certs=certs+1 WHERE {row}.passed=1
+                AND (dim, key) IN ({cert_keys(f"{pair} AND s.cert_result_id = {row}.id")});"""
+    else:
+        # the next valid pass always has a higher id than the credited one
+        certs = f"""
+            UPDATE stats_rollup SET certs=certs-1 WHERE {row}.passed=1
+                AND (dim, key) IN ({cert_keys(f"{pair} AND s.cert_result_id = {row}.id")});
+            UPDATE stats_user_course SET passes=passes-1 WHERE {row}.passed=1 AND {own};
+            UPDATE stats_user_course SET (cert_result_id, {', '.join(CERT_COLUMNS)}) = (
+                    SELECT r.id, {', '.join(cert_values('r'))} FROM results r
+                    WHERE r.user_email={row}.user_email AND r.course_id={row}.course_id
+                      AND r.is_valid=1 AND r.passed=1 AND r.id != {row}.id
+                    ORDER BY r.id LIMIT 1)
+                WHERE {row}.passed=1 AND {own} AND cert_result_id={row}.id;
+            UPDATE stats_rollup SET certs=certs+1 WHERE {row}.passed=1
+                AND (dim, key) IN ({cert_keys(f"{pair} AND s.cert_result_id > {row}.id")});"""
+    return f"""
+            INSERT INTO stats_rollup (dim, key, attempts, passes) VALUES {values}
+                ON CONFLICT(dim, key) DO UPDATE SET attempts=attempts+excluded.attempts, passes=passes+excluded.passes;
+            {certs}"""
+
+
+def rebuild_stats(db):
+    """Recompute every rollup from results (used by the migrations and `flask rebuild-stats`).
+
+    Same attribution as the triggers: each certificate counts once, on its first valid pass.
+    """
+    run_script(db, f'''
+        DELETE FROM stats_rollup;
+        DELETE FROM stats_user_course;
+        INSERT INTO stats_user_course (user_email, course_id, passes, cert_result_id, {', '.join(CERT_COLUMNS)})
+            SELECT r.user_email, r.course_id, p.passes, r.id, {', '.join(cert_values('r'))}
+            FROM (SELECT MIN(id) AS first_id, COUNT(*) AS passes FROM results
+                  WHERE is_valid=1 AND passed=1 GROUP BY user_email, course_id) p
+            JOIN results r ON r.id=p.first_id;
+    ''')
+    for dim, key in stats_keys('r'):
+        db.execute(f"""INSERT INTO stats_rollup (dim, key, attempts, passes)
+                       SELECT {dim}, {key}, COUNT(*), SUM(r.passed) FROM results r WHERE r.is_valid=1 GROUP BY {key}""")
+    db.execute(f"""UPDATE stats_rollup SET certs=c.n
+                   FROM (SELECT dim, key, COUNT(*) AS n FROM ({cert_keys('1=1')}) GROUP BY dim, key) c
+                   WHERE stats_rollup.dim=c.dim AND stats_rollup.key=c.key""")
+
+
+STATS_TRIGGERS = [
+    # (name, event, condition, row, sign)
+    ('trg_results_stats_ins', 'INSERT', 'NEW.is_valid=1', 'NEW', '+'),
+    ('trg_results_stats_invalidate', 'UPDATE OF is_valid', 'OLD.is_valid=1 AND NEW.is_valid=0', 'OLD', '-'),
+    ('trg_results_stats_revalidate', 'UPDATE OF is_valid', 'OLD.is_valid=0 AND NEW.is_valid=1', 'NEW', '+'),
+    ('trg_results_stats_del', 'DELETE', 'OLD.is_valid=1', 'OLD', '-'),
+]
+
+
+# Migration 007 as shipped, with the rollup helpers it used frozen under _007 names. Its certificate
+# attribution drifted from its own rebuild; migration 012 replaces the triggers and counters.
+# Rollup dimensions of a results row `R` (NEW or OLD inside a trigger).
+STATS_DIMENSIONS_007 = [
+    ("'all'", "''"),
+    ("'course'", "CAST(R.course_id AS TEXT)"),
+    ("'department'", "COALESCE(R.department, '')"),
+    ("'team'", "COALESCE(R.team, '')"),
+    ("'day'", "date(R.completed_at)"),
+]
+
+
+def stats_trigger_body_007(row, sign):
+    """SQL that adds (sign='+') or removes (sign='-') one valid result `row` from the rollups.
+
+    A certificate is one (user, course) pair with at least one valid pass; it is
+    attributed to the dimensions of the pass that created it.
+    """
+    values = ',\n'.join(f"({dim}, {key}, {sign}1, {sign}R.passed)" for dim, key in STATS_DIMENSIONS_007)
+    match = ' OR '.join(f"(dim={dim} AND key={key})" for dim, key in STATS_DIMENSIONS_007)
+    user_course = "user_email=R.user_email AND course_id=R.course_id"
+    if sign == '+':
+        certs = f"""
+            INSERT INTO stats_user_course (user_email, course_id, passes)
+                SELECT R.user_email, R.course_id, 1 WHERE R.passed=1
+                ON CONFLICT(user_email, course_id) DO UPDATE SET passes=passes+1;
+            UPDATE stats_rollup SET certs=certs+1
+                WHERE R.passed=1 AND (SELECT passes FROM stats_user_course WHERE {user_course})=1 AND ({match});"""
+    else:
+        certs = f"""
+            UPDATE stats_rollup SET certs=certs-1
+                WHERE R.passed=1 AND (SELECT passes FROM stats_user_course WHERE {user_course})=1 AND ({match});
+            UPDATE stats_user_course SET passes=passes-1 WHERE R.passed=1 AND {user_course};"""
+    return f"""
+            INSERT INTO stats_rollup (dim, key, attempts, passes) VALUES {values}
+                ON CONFLICT(dim, key) DO UPDATE SET attempts=attempts+excluded.attempts, passes=passes+excluded.passes;
+            {certs}""".replace('R.', f'{row}.')
+
+
+def rebuild_stats_007(db):
+    """Recompute every rollup from results, as migration 007 shipped it."""
+    pair = "CASE WHEN passed=1 THEN user_email || '|' || course_id END"
+    run_script(db, f'''
+        DELETE FROM stats_rollup;
+        DELETE FROM stats_user_course;
+        INSERT INTO stats_user_course (user_email, course_id, passes)
+            SELECT user_email, course_id, COUNT(*) FROM results WHERE is_valid=1 AND passed=1 GROUP BY user_email, course_id;
+    ''')
+    for dim, key in STATS_DIMENSIONS_007:
+        key = key.replace('R.', '')
+        db.execute(f"""INSERT INTO stats_rollup (dim, key, attempts, passes, certs)
+                       SELECT {dim}, {key}, COUNT(*), SUM(passed), COUNT(DISTINCT {pair})
+                       FROM results WHERE is_valid=1 GROUP BY {key}""")
+
+
+def migrate_007_stats_rollups(db):
+    """Per-course/department/team/day attempt, pass and certificate counters kept by triggers."""
+    # department/team are snapshotted on each result so later profile edits don't skew the rollups
+    db.execute("ALTER TABLE results ADD COLUMN department TEXT")
+    db.execute("ALTER TABLE results ADD COLUMN team TEXT")
+    run_script(db, '''
+        UPDATE results SET department=(SELECT department FROM users u WHERE u.email=results.user_email),
+                           team=(SELECT team FROM users u WHERE u.email=results.user_email);
+        CREATE TABLE IF NOT EXISTS stats_rollup (
+            dim TEXT NOT NULL, key TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            passes INTEGER NOT NULL DEFAULT 0,
+            certs INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dim, key)
+        );
+        CREATE TABLE IF NOT EXISTS stats_user_course (
+            user_email TEXT NOT NULL, course_id INTEGER NOT NULL,
+            passes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_email, course_id)
+        );
+    ''')
+    rebuild_stats_007(db)
+    run_script(db, f'''
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_ins AFTER INSERT ON results WHEN NEW.is_valid=1 BEGIN
+            {stats_trigger_body_007('NEW', '+')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_invalidate AFTER UPDATE OF is_valid ON results
+        WHEN OLD.is_valid=1 AND NEW.is_valid=0 BEGIN
+            {stats_trigger_body_007('OLD', '-')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_revalidate AFTER UPDATE OF is_valid ON results
+        WHEN OLD.is_valid=0 AND NEW.is_valid=1 BEGIN
+            {stats_trigger_body_007('NEW', '+')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_del AFTER DELETE ON results WHEN OLD.is_valid=1 BEGIN
+            {stats_trigger_body_007('OLD', '-')}
+        END;
+    ''')
+
+
+
+def migrate_008_history_indexes(db):
+    """Indexes for filtered, keyset-paginated history queries (analytics API, exports)."""
+    run_script(db, '''
+        CREATE INDEX IF NOT EXISTS idx_results_user_date ON results(user_email, completed_at);
+        CREATE INDEX IF NOT EXISTS idx_results_dept_date ON results(department, completed_at);
+        CREATE INDEX IF NOT EXISTS idx_results_course_date ON results(course_id, completed_at);
+    ''')
+
+
+
+def migrate_009_results_changelog(db):
+    """Change log of result invalidations/deletions for the HR delta feed (inserts use results.id)."""
+    run_script(db, '''
+        CREATE TABLE IF NOT EXISTS results_changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            result_id INTEGER NOT NULL,
+            change TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_results_log_invalidate AFTER UPDATE OF is_valid ON results
+        WHEN OLD.is_valid=1 AND NEW.is_valid=0 BEGIN
+            INSERT INTO results_changelog (result_id, change) VALUES (OLD.id, 'invalidate');
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_results_log_revalidate AFTER UPDATE OF is_valid ON results
+        WHEN OLD.is_valid=0 AND NEW.is_valid=1 BEGIN
+            INSERT INTO results_changelog (result_id, change) VALUES (NEW.id, 'revalidate');
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_results_log_delete AFTER DELETE ON results BEGIN
+            INSERT INTO results_changelog (result_id, change) VALUES (OLD.id, 'delete');
+        END;
+    ''')
+
+
+def migrate_010_blobs(db):
+    """Content-addressed blob store; signatures move out of users.signature_data into it."""
+    run_script(db, '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            content_type TEXT NOT NULL,
+            data BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        ALTER TABLE users ADD COLUMN signature_hash TEXT;
+    ''')
+    rows = db.execute("SELECT id, signature_data FROM users WHERE signature_data IS NOT NULL AND signature_data!=''").fetchall()
+    for row in rows:
+        blob = parse_data_url(row['signature_data'])
+        if not blob:
+            # keep what can't be parsed rather than lose it; it stays in signature_data for manual repair
+            print(f"[DB] user {row['id']}: signature_data is not a data URL, left in place")
+            continue
+        db.execute("UPDATE users SET signature_hash=?, signature_data=NULL WHERE id=?", (put_blob(db, *blob), row['id']))
+
+
+def migrate_011_outbox_attachments(db):
+    """Queued emails can carry file attachments (JSON list of [path, filename])."""
+    db.execute("ALTER TABLE email_outbox ADD COLUMN attachments TEXT")
+
+
+def migrate_012_cert_attribution(db):
+    """Remember which pass each certificate is credited to, so triggers and rebuild_stats agree."""
+    for col in ('cert_result_id INTEGER',) + tuple(f'{c} TEXT' for c in CERT_COLUMNS):
+        db.execute(f"ALTER TABLE stats_user_course ADD COLUMN {col}")
+    for name, event, condition, row, sign in STATS_TRIGGERS:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"CREATE TRIGGER {name} AFTER {event} ON results WHEN {condition} BEGIN "
+                   f"{stats_trigger_body(row, sign)} END")
+    rebuild_stats(db)
+
+
+MIGRATIONS = [
+    migrate_001_base,
+    migrate_002_indexes,
+    migrate_003_question_count,
+    migrate_004_course_targets,
+    migrate_005_search_index,
+    migrate_006_content_version,
+    migrate_007_stats_rollups,
+    migrate_008_history_indexes,
+    migrate_009_results_changelog,
+    migrate_010_blobs,
+    migrate_011_outbox_attachments,
+    migrate_012_cert_attribution,
+]
+
+
+def init_db():
+    """Apply pending migrations. A warm boot costs a single PRAGMA read."""
+    db = sqlite3.connect(DATABASE, isolation_level=None, timeout=30)
+    db.row_factory = sqlite3.Row
+    try:
+        if db.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return
+        for version, migrate in enumerate(MIGRATIONS, start=1):
+            # BEGIN IMMEDIATE serialises gunicorn workers booting at the same time
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if db.execute("PRAGMA user_version").fetchone()[0] < version:
+                    migrate(db)
+                    db.execute(f"PRAGMA user_version={version}")
+                    print(f"[DB] applied migration {version}: {migrate.__name__}")
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+    finally:
+        db.close()
+
+
+# ─────────── BLOBS ───────────
+BLOB_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/gif')
+
+
+def parse_data_url(value):
+    """(content_type, bytes) from a base64 image data URL, or None if it isn't one we accept."""
+    m = re.match(r'data:([\w/+.-]+);base64,(.*)$', value or '', re.S)
+    if not m or m.group(1) not in BLOB_CONTENT_TYPES:
+        return None
+    try:
+        data = base64.b64decode(m.group(2), validate=True)
+    except ValueError:
+        return None
+    return (m.group(1), data) if data else None
+
+
+def put_blob(db, content_type, data):
+    """Store bytes under their SHA-256 and return the hash. Identical content is stored once."""
+    digest = hashlib.sha256(data).hexdigest()
+    db.execute("INSERT OR IGNORE INTO blobs (hash, content_type, data) VALUES (?,?,?)",
+               (digest, content_type, sqlite3.Binary(data)))
+    return digest
+
+
+def drop_blob_if_unused(db, digest):
+    """Delete a signature blob once no user points at it any more."""
+    if digest:
+        db.execute("DELETE FROM blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM users WHERE signature_hash=?)",
+                   (digest, digest))
+
+
+# Representative statements from the hot routes; `flask explain-queries` prints their plans.
+HOT_QUERIES = [
+    ("dashboard: my valid results",
+     "SELECT * FROM results WHERE user_email=? AND is_valid=1", ('a@b',)),
+    ("attempt info: results per user+course",
+     "SELECT * FROM results WHERE user_email=? AND course_id=? AND is_valid=1 ORDER BY completed_at DESC", ('a@b', 1)),
+    ("attempt info: open retest requests",
+     "SELECT id FROM retest_requests WHERE course_id=? AND created_at > ?", (1, '2000-01-01')),
+    ("quiz: question bank",
+     "SELECT * FROM questions WHERE course_id=?", (1,)),
+    ("learner visibility: course targets",
+     "SELECT course_id FROM course_targets WHERE (target_type='department' AND value=?) "
+     "OR (target_type='team' AND value=?) OR (target_type='job_level' AND value=?)", ('Back-office', 'Stock Team', 'Staff')),
+    ("category listing",
+     "SELECT * FROM courses WHERE category=? ORDER BY created_at DESC", ('SOP',)),
+    ("course listing",
+     "SELECT * FROM courses ORDER BY created_at DESC", ()),
+    ("reminder targets: department",
+     "SELECT * FROM users WHERE department=? AND verified=1 AND status='active'", ('Back-office',)),
+    ("reminder targets: team",
+     "SELECT * FROM users WHERE team=? AND verified=1 AND status='active'", ('Stock Team',)),
+    ("reminder targets: all",
+     "SELECT * FROM users WHERE role IN ('learner','trainer') AND verified=1 AND status='active'", ()),
+    ("analytics / export history",
+     "SELECT r.* FROM results r WHERE r.is_valid=1 ORDER BY r.completed_at DESC", ()),
+    ("outbox: due rows",
+     "SELECT * FROM email_outbox WHERE status IN ('pending','sending') AND next_attempt_at <= datetime('now') "
+     "ORDER BY next_attempt_at, id LIMIT 50", ()),
+]
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the stats rollup tables from results."""
+    db = get_db()
+    rebuild_stats(db)
     db.commit()
-    db.close()
+    print("[STATS] rollups rebuilt")
+
+
+@app.cli.command('gc-avatars')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be removed.')
+@click.option('--grace', default=3600, show_default=True, help='Keep files younger than this many seconds.')
+def gc_avatars_command(dry_run, grace):
+    """Delete avatar files that no user references."""
+    folder = app.config['AVATAR_UPLOAD_FOLDER']
+    used = {r[0] for r in get_db().execute("SELECT avatar_url FROM users WHERE avatar_url IS NOT NULL").fetchall()}
+    cutoff = time.time() - grace  # an upload is written before its UPDATE commits
+    removed = freed = 0
+    for entry in os.scandir(folder):
+        if not entry.is_file() or entry.name in used or entry.stat().st_mtime > cutoff:
+            continue
+        removed += 1
+        freed += entry.stat().st_size
+        if not dry_run:
+            os.remove(entry.path)
+    print(f"[AVATAR] {'would remove' if dry_run else 'removed'} {removed} file(s), {freed // 1024} KB")
+
+
+@app.cli.command('explain-queries')
+def explain_queries_command():
+    """Print EXPLAIN QUERY PLAN for every hot query."""
+    db = get_db()
+    print(f"schema version {db.execute('PRAGMA user_version').fetchone()[0]} / {len(MIGRATIONS)}")
+    for name, sql, params in HOT_QUERIES:
+        print(f"\n── {name}\n   {sql}")
+        for row in db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+            print(f"   {row['detail']}")
+
+
 
 
 # ─────────── HELPERS ───────────
@@ -299,8 +1219,7 @@ def admin_required(f):
     def decorated(*args, **kwargs):
         if 'user_email' not in session:
             return redirect(url_for('login'))
-        db = get_db()
-        user = db.execute("SELECT role FROM users WHERE email=?", (session['user_email'],)).fetchone()
+        user = get_current_user()
         if not user or user['role'] not in ('admin', 'trainer'):
             flash('Bạn không có quyền truy cập.', 'error')
             return redirect(url_for('dashboard'))
@@ -312,18 +1231,50 @@ def admin_only(f):
     def decorated(*args, **kwargs):
         if 'user_email' not in session:
             return redirect(url_for('login'))
-        db = get_db()
-        user = db.execute("SELECT role FROM users WHERE email=?", (session['user_email'],)).fetchone()
+        user = get_current_user()
         if not user or user['role'] != 'admin':
             flash('Chỉ Admin mới có quyền.', 'error')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
     return decorated
 
+def admin_or_sync_token(f):
+    """Allow a logged-in admin/trainer, or a machine client sending `Authorization: Bearer <HR_SYNC_TOKEN>`."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.headers.get('Authorization', '')
+        if HR_SYNC_TOKEN and secrets.compare_digest(auth, f'Bearer {HR_SYNC_TOKEN}'):
+            return f(*args, **kwargs)
+        if 'user_email' not in session:
+            return jsonify(error='unauthorized'), 401
+        return admin_required(f)(*args, **kwargs)
+    return decorated
+
+# Columns every page needs; password_hash loads on demand.
+USER_COLUMNS = ("id, email, name, department, team, job_title, job_level, role, status, verified, "
+                "avatar_url, signature_hash, created_at")
+
+
+class CurrentUser(dict):
+    """The logged-in user's lean row. Heavy columns are fetched the first time they are read."""
+    LAZY_COLUMNS = ('password_hash',)
+
+    def __missing__(self, key):
+        if key not in self.LAZY_COLUMNS:
+            raise KeyError(key)
+        row = get_db().execute(f"SELECT {key} FROM users WHERE id=?", (self['id'],)).fetchone()
+        self[key] = row[key] if row else None
+        return self[key]
+
+
 def get_current_user():
+    """The session user, loaded once per request and shared by the decorators and the view."""
     if 'user_email' not in session:
         return None
-    return get_db().execute("SELECT * FROM users WHERE email=?", (session['user_email'],)).fetchone()
+    if 'current_user' not in g:
+        row = get_db().execute(f"SELECT {USER_COLUMNS} FROM users WHERE email=?", (session['user_email'],)).fetchone()
+        g.current_user = CurrentUser(row) if row else None
+    return g.current_user
 
 def get_youtube_embed(url):
     if not url: return None
@@ -337,57 +1288,340 @@ def generate_code():
 
 
 # ─────────── SMTP (FIXED) ───────────
-def send_email(to_email, subject, html_body):
-    """Send email with multiple fallback methods. Returns True on success."""
-    sender = SMTP_FROM or SMTP_USER
-    if not SMTP_USER or not SMTP_PASS:
-        print(f"[EMAIL-SKIP] SMTP_USER or SMTP_PASS not set. To={to_email} Subject={subject}")
-        return False
-    if not sender:
-        sender = SMTP_USER
+SMTP_METHODS = ('starttls', 'ssl', 'plain')
+SMTP_MAX_PER_SESSION = int(os.environ.get('SMTP_MAX_PER_SESSION', '100'))  # Gmail drops long sessions
+SMTP_BREAKER_THRESHOLD = int(os.environ.get('SMTP_BREAKER_THRESHOLD', '3'))  # consecutive connect failures
+SMTP_BREAKER_COOLDOWN = int(os.environ.get('SMTP_BREAKER_COOLDOWN', '300'))   # seconds to fail fast
+
+
+class SmtpUnavailable(smtplib.SMTPException):
+    """Raised without touching the network while the SMTP circuit breaker is open."""
+
+
+def get_smtp_state():
+    """Transport cache + breaker state, shared by all workers through the settings table."""
+    rows = get_db().execute(
+        "SELECT key, value FROM settings WHERE key IN ('smtp_transport','smtp_failures','smtp_open_until')").fetchall()
+    kv = {r['key']: r['value'] for r in rows}
+    open_until = float(kv.get('smtp_open_until') or 0)
+    return {
+        'transport': kv.get('smtp_transport') or '',
+        'failures': int(kv.get('smtp_failures') or 0),
+        'open_until': open_until,
+        'open_until_str': datetime.fromtimestamp(open_until).strftime('%H:%M:%S') if open_until else '',
+        'is_open': open_until > time.time(),
+    }
+
+
+def save_smtp_state(**values):
+    db = get_db()
+    db.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                   [(f'smtp_{k}', str(v)) for k, v in values.items()])
+    db.commit()
+
 
-    msg = MIMEMultipart('alternative')
+def record_smtp_failure(state):
+    failures = state['failures'] + 1
+    if failures >= SMTP_BREAKER_THRESHOLD:
+        save_smtp_state(failures=failures, open_until=time.time() + SMTP_BREAKER_COOLDOWN)
+        print(f"[EMAIL-BREAKER] open for {SMTP_BREAKER_COOLDOWN}s after {failures} failures")
+    else:
+        save_smtp_state(failures=failures)
+
+
+def build_message(to_email, subject, html_body, attachments=()):
+    msg = MIMEMultipart('mixed' if attachments else 'alternative')
     msg['Subject'] = subject
-    msg['From'] = sender
+    msg['From'] = SMTP_FROM or SMTP_USER
     msg['To'] = to_email
     msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-
-    # Method 1: STARTTLS (port 587)
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20) as server:
+    for path, filename in attachments:
+        if not os.path.isfile(path):
+            print(f"[EMAIL-ATTACH] missing {path}, sending without it")
+            continue
+        ctype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        part = MIMEBase(*ctype.split('/', 1))
+        with open(path, 'rb') as f:
+            part.set_payload(f.read())
+        encoders.encode_base64(part)
+        # images (the SVG certificate) go inline so mail clients show them instead of only listing a file
+        part.add_header('Content-Disposition', 'inline' if ctype.startswith('image/') else 'attachment',
+                        filename=filename)
+        msg.attach(part)
+    return msg
+
+
+def smtp_connect(method):
+    """Open and authenticate an SMTP connection using one transport method."""
+    if method == 'starttls':
+        # Method 1: STARTTLS (port 587)
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20)
+        try:
             server.ehlo()
             server.starttls(context=ssl.create_default_context())
             server.ehlo()
             server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
-        print(f"[EMAIL-OK] Sent to {to_email} via STARTTLS")
-        return True
-    except Exception as e1:
-        print(f"[EMAIL-TLS-FAIL] {e1}")
-
-    # Method 2: SSL direct (port 465)
+        except Exception:
+            server.close(); raise
+        return server
+    if method == 'ssl':
+        # Method 2: SSL direct (port 465)
+        server = smtplib.SMTP_SSL(SMTP_SERVER, 465, context=ssl.create_default_context(), timeout=20)
+    else:
+        # Method 3: Plain (no encryption)
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20)
     try:
-        ctx = ssl.create_default_context()
-        with smtplib.SMTP_SSL(SMTP_SERVER, 465, context=ctx, timeout=20) as server:
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
-        print(f"[EMAIL-OK] Sent to {to_email} via SSL")
-        return True
-    except Exception as e2:
-        print(f"[EMAIL-SSL-FAIL] {e2}")
+        server.login(SMTP_USER, SMTP_PASS)
+    except Exception:
+        server.close(); raise
+    return server
+
+
+class SmtpSession:
+    """One authenticated SMTP connection reused for many messages.
+
+    Reconnects transparently when the server drops the session or after
+    SMTP_MAX_PER_SESSION messages.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.method = None
+        self.sent_on_connection = 0
+
+    def open(self):
+        state = get_smtp_state()
+        if state['is_open']:
+            raise SmtpUnavailable(f"SMTP circuit open until {state['open_until_str']}")
+        # the transport that worked last time goes first
+        for method in sorted(SMTP_METHODS, key=lambda m: m != state['transport']):
+            try:
+                self.server = smtp_connect(method)
+            except Exception as e:
+                print(f"[EMAIL-{method.upper()}-FAIL] {e}")
+                continue
+            self.method = method
+            self.sent_on_connection = 0
+            if state['transport'] != method or state['failures'] or state['open_until']:
+                save_smtp_state(transport=method, failures=0, open_until=0)
+            return
+        record_smtp_failure(state)
+        raise smtplib.SMTPException('All SMTP methods failed')
+
+    def close(self):
+        if self.server is not None:
+            try: self.server.quit()
+            except Exception: pass
+        self.server = None
+
+    def send(self, to_email, subject, html_body, attachments=()):
+        """Send one message. Raises on failure."""
+        msg = build_message(to_email, subject, html_body, attachments)
+        if self.server is not None and self.sent_on_connection >= SMTP_MAX_PER_SESSION:
+            self.close()
+        try:
+            for attempt in (1, 2):
+                if self.server is None:
+                    self.open()
+                try:
+                    self.server.send_message(msg)
+                    self.sent_on_connection += 1
+                    break
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPHeloError, ConnectionError, TimeoutError):
+                    # session dropped — reconnect once and retry this message
+                    self.close()
+                    if attempt == 2: raise
+        except SmtpUnavailable:
+            raise  # nothing was attempted
+        except Exception:
+            count_metric('lms_emails_total', (('transport', self.method or 'none'), ('outcome', 'failed')))
+            raise
+        count_metric('lms_emails_total', (('transport', self.method), ('outcome', 'sent')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    # Method 3: Plain (no encryption)
+
+def send_email(to_email, subject, html_body):
+    """Send email with multiple fallback methods. Returns True on success."""
+    if not SMTP_USER or not SMTP_PASS:
+        print(f"[EMAIL-SKIP] SMTP_USER or SMTP_PASS not set. To={to_email} Subject={subject}")
+        return False
+    t0 = time.perf_counter()
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20) as server:
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
-        print(f"[EMAIL-OK] Sent to {to_email} via plain")
+        with SmtpSession() as smtp:
+            smtp.send(to_email, subject, html_body)
+            print(f"[EMAIL-OK] Sent to {to_email} via {smtp.method}")
         return True
-    except Exception as e3:
-        print(f"[EMAIL-PLAIN-FAIL] {e3}")
+    except Exception as e:
+        print(f"[EMAIL-ERROR] All methods failed for {to_email}: {e}")
+        return False
+    finally:
+        record_timing('email', time.perf_counter() - t0)
+
+
+def send_bulk_email(messages):
+    """Deliver (to_email, subject, html_body[, attachments]) tuples over one SMTP session.
+
+    Returns a list of (ok, error) per message, in order. It stops early if the circuit
+    breaker opens, so messages past the end of the list were never attempted.
+    """
+    outcome = []
+    with SmtpSession() as smtp:
+        for to_email, subject, html_body, *attachments in messages:
+            try:
+                smtp.send(to_email, subject, html_body, *attachments)
+                outcome.append((True, None))
+            except SmtpUnavailable as e:
+                print(f"[EMAIL-SKIP] {len(messages) - len(outcome)} emails not sent: {e}")
+                break
+            except Exception as e:
+                print(f"[EMAIL-FAIL] {to_email}: {e}")
+                outcome.append((False, str(e)[:500]))
+    return outcome
+
+
+# ─────────── EMAIL OUTBOX ───────────
+def smtp_configured():
+    return bool(SMTP_USER and SMTP_PASS)
+
+
+def queue_email(to_email, subject, html_body, attachments=None):
+    """Queue an email for the outbox worker. Returns True if it was queued.
+
+    Requests never talk to SMTP directly; `flask send-emails` delivers the rows.
+    `attachments` is a list of (path, filename); the files are read at send time.
+    """
+    if not smtp_configured():
+        print(f"[EMAIL-SKIP] SMTP_USER or SMTP_PASS not set. To={to_email} Subject={subject}")
+        return False
+    db = get_db()
+    db.execute("INSERT INTO email_outbox (to_email,subject,html_body,max_attempts,attachments) VALUES (?,?,?,?,?)",
+               (to_email, subject, html_body, OUTBOX_MAX_ATTEMPTS,
+                json.dumps(attachments) if attachments else None))
+    db.commit()
+    return True
+
+
+def queue_emails(messages):
+    """Queue many (to_email, subject, html_body) tuples in one transaction. Returns count queued."""
+    if not messages:
+        return 0
+    if not smtp_configured():
+        print(f"[EMAIL-SKIP] SMTP_USER or SMTP_PASS not set. {len(messages)} emails dropped")
+        return 0
+    db = get_db()
+    db.executemany("INSERT INTO email_outbox (to_email,subject,html_body,max_attempts) VALUES (?,?,?,?)",
+                   [(to, subj, body, OUTBOX_MAX_ATTEMPTS) for to, subj, body in messages])
+    db.commit()
+    return len(messages)
+
+
+def outbox_retry_delay(attempts):
+    """Seconds to wait before the next attempt (exponential backoff)."""
+    return min(OUTBOX_RETRY_BASE * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_CAP)
+
+
+def claim_outbox_batch(db, limit):
+    """Lease up to `limit` due rows. Safe to run from several worker processes."""
+    due = db.execute(
+        """SELECT * FROM email_outbox
+           WHERE status IN ('pending','sending') AND next_attempt_at <= datetime('now')
+           ORDER BY next_attempt_at, id LIMIT ?""", (limit,)).fetchall()
+    claimed = []
+    for row in due:
+        # compare-and-set: only one worker wins a row
+        cur = db.execute(
+            """UPDATE email_outbox SET status='sending', attempts=attempts+1,
+                      next_attempt_at=datetime('now', ?)
+               WHERE id=? AND status=? AND next_attempt_at=?""",
+            (f'+{OUTBOX_LEASE} seconds', row['id'], row['status'], row['next_attempt_at']))
+        if cur.rowcount:
+            claimed.append(row)
+    db.commit()
+    return claimed
+
+
+def release_outbox_rows(db, rows):
+    """Hand claimed rows that were never attempted back to the queue, without charging an attempt."""
+    db.executemany("""UPDATE email_outbox SET status='pending', attempts=attempts-1, next_attempt_at=datetime('now')
+                      WHERE id=? AND status='sending'""", [(r['id'],) for r in rows])
+    db.commit()
+
+
+def mark_outbox_result(db, row, ok, error=None):
+    attempts = row['attempts'] + 1
+    if ok:
+        db.execute("UPDATE email_outbox SET status='sent', sent_at=CURRENT_TIMESTAMP, last_error=NULL WHERE id=?",
+                   (row['id'],))
+    elif attempts >= (row['max_attempts'] or OUTBOX_MAX_ATTEMPTS):
+        db.execute("UPDATE email_outbox SET status='failed', last_error=? WHERE id=?", (error, row['id']))
+    else:
+        db.execute("UPDATE email_outbox SET status='pending', last_error=?, next_attempt_at=datetime('now', ?) WHERE id=?",
+                   (error, f'+{outbox_retry_delay(attempts)} seconds', row['id']))
+    db.commit()
+
 
-    print(f"[EMAIL-ERROR] All methods failed for {to_email}")
-    return False
+def process_outbox(db, limit=50):
+    """Deliver one batch of due emails over a single SMTP session. Returns (sent, failed)."""
+    if get_smtp_state()['is_open']:
+        return 0, 0  # leave rows queued instead of burning their attempts
+    rows = claim_outbox_batch(db, limit)
+    if not rows:
+        return 0, 0
+    try:
+        outcome = send_bulk_email([(r['to_email'], r['subject'], r['html_body'], json.loads(r['attachments'] or '[]'))
+                                   for r in rows])
+    except Exception as e:
+        # could not even open a session: every row goes back to the queue
+        outcome = [(False, str(e)[:500])] * len(rows)
+    for row, (ok, error) in zip(rows, outcome):
+        mark_outbox_result(db, row, ok, error)
+    # the breaker opened mid-batch: the rest were never tried
+    release_outbox_rows(db, rows[len(outcome):])
+    sent = sum(1 for ok, _ in outcome if ok)
+    return sent, len(outcome) - sent
+
+
+def get_outbox_stats():
+    rows = get_db().execute("SELECT status, COUNT(*) AS cnt FROM email_outbox GROUP BY status").fetchall()
+    stats = {'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0}
+    stats.update({r['status']: r['cnt'] for r in rows})
+    return stats
+
+
+@app.cli.command('send-emails')
+@click.option('--once', is_flag=True, help='Drain the due emails once and exit.')
+@click.option('--batch', default=50, show_default=True, help='Rows sent per SMTP session.')
+@click.option('--interval', default=5.0, show_default=True, help='Seconds to sleep when the queue is empty.')
+def send_emails_command(once, batch, interval):
+    """Deliver queued emails from email_outbox (retries with backoff)."""
+    db = get_db()
+    print(f"[OUTBOX] worker started (batch={batch}, once={once})")
+    while True:
+        try:
+            sent, failed = process_outbox(db, batch)
+        except Exception as e:
+            # e.g. "database is locked" during a write burst: nothing supervises this
+            # process, so log, back off and keep polling instead of dying.
+            print(f"[OUTBOX] poll failed: {e}")
+            try: db.rollback()
+            except sqlite3.Error: pass
+            if once:
+                raise
+            time.sleep(interval)
+            continue
+        if sent or failed:
+            print(f"[OUTBOX] sent={sent} failed={failed}")
+            if METRICS_TOKEN:
+                metrics.flush()
+        if once and not (sent or failed):
+            break
+        if not (sent or failed):
+            time.sleep(interval)
 
 
 def send_verification_email(to_email, code):
@@ -400,13 +1634,14 @@ def send_verification_email(to_email, code):
             <span style="font-size:32px;font-weight:bold;color:#003047;letter-spacing:8px">{code}</span></div>
         <p style="color:#888;font-size:13px">Mã có hiệu lực 30 phút.</p>
         <p style="color:#888;font-size:12px">— MANI Medical Hanoi</p></div></div>"""
-    ok = send_email(to_email, 'MANI Learning Hub - Xác nhận đăng ký', html)
+    ok = queue_email(to_email, 'MANI Learning Hub - Xác nhận đăng ký', html)
     if not ok:
         print(f"[VERIFY-CODE] {to_email} => {code}")
     return ok
 
 
-def send_certificate_email(to_email, user_name, course_title, score, total, date_str, trainer_name=''):
+def send_certificate_email(to_email, user_name, course_title, score, total, date_str, trainer_name='',
+                           attachment=None, cert_url=''):
     html = f"""<div style="font-family:Arial,sans-serif;max-width:500px;margin:0 auto">
     <div style="background:#003047;padding:20px;text-align:center;border-radius:10px 10px 0 0">
         <h2 style="color:#FFE100;margin:0">🏆 Chứng chỉ hoàn thành</h2></div>
@@ -418,11 +1653,14 @@ def send_certificate_email(to_email, user_name, course_title, score, total, date
             <span style="color:#28A745;font-weight:bold">Điểm: {score}/{total} ✓</span></div>
         <p>Ngày: {date_str}</p>
         {f'<p>Trainer: {trainer_name}</p>' if trainer_name else ''}
+        {f'<p><a href="{cert_url}" style="color:#003047;font-weight:bold">Xem chứng chỉ</a> '
+         f'(nếu ứng dụng email không hiển thị được file SVG đính kèm)</p>' if cert_url else ''}
         <p style="color:#888;font-size:12px">— MANI Medical Hanoi</p></div></div>"""
-    return send_email(to_email, f'🏆 Chứng chỉ: {course_title}', html)
+    return queue_email(to_email, f'🏆 Chứng chỉ: {course_title}', html, [attachment] if attachment else None)
 
 
-def send_reminder_email(to_email, user_name, course_title, message_text, sender_name):
+def reminder_email(user_name, course_title, message_text, sender_name):
+    """Return (subject, html) for a training reminder."""
     html = f"""<div style="font-family:Arial,sans-serif;max-width:500px;margin:0 auto">
     <div style="background:#003047;padding:20px;text-align:center;border-radius:10px 10px 0 0">
         <h2 style="color:#FFE100;margin:0">📢 Nhắc nhở đào tạo</h2></div>
@@ -432,10 +1670,15 @@ def send_reminder_email(to_email, user_name, course_title, message_text, sender_
             <strong style="color:#003047">{course_title}</strong>
             <p style="margin:8px 0 0;color:#555">{message_text}</p></div>
         <p style="color:#888;font-size:12px">Gửi bởi: {sender_name}<br>— MANI Medical Hanoi</p></div></div>"""
-    return send_email(to_email, f'📢 Nhắc nhở: {course_title}', html)
+    return f'📢 Nhắc nhở: {course_title}', html
 
 
-def send_retest_email(to_email, user_name, course_title, deadline_str, sender_name):
+def send_reminder_email(to_email, user_name, course_title, message_text, sender_name):
+    return queue_email(to_email, *reminder_email(user_name, course_title, message_text, sender_name))
+
+
+def retest_email(user_name, course_title, deadline_str, sender_name):
+    """Return (subject, html) for a retest request."""
     msg = (
         f'vui lòng hoàn thành bài test về bài đào tạo "{course_title}" trước ngày {deadline_str}.'
         if deadline_str else
@@ -450,40 +1693,558 @@ def send_retest_email(to_email, user_name, course_title, deadline_str, sender_na
             <strong style="color:#003047">{course_title}</strong>
             <p style="margin:8px 0 0;color:#555">{msg}</p></div>
         <p style="color:#888;font-size:12px">Gửi bởi: {sender_name}<br>— MANI Medical Hanoi</p></div></div>"""
-    return send_email(to_email, 'Yêu cầu hoàn thành bài kiểm tra', html)
+    return 'Yêu cầu hoàn thành bài kiểm tra', html
+
+
+def send_retest_email(to_email, user_name, course_title, deadline_str, sender_name):
+    return queue_email(to_email, *retest_email(user_name, course_title, deadline_str, sender_name))
+
+
+# Who may see a course: admins/trainers see all, learners need a matching course target.
+def targeted_course_ids(department, team, job_level):
+    """Subquery of course ids targeting a department, team or job level (each an SQL expression)."""
+    return f"""SELECT course_id FROM course_targets
+               WHERE (target_type='department' AND value={department})
+                  OR (target_type='team' AND value={team})
+                  OR (target_type='job_level' AND value={job_level})"""
+
+
+USER_SEES_COURSE = (f"(u.role IN ('admin','trainer') OR "
+                    f"c.id IN ({targeted_course_ids('u.department', 'u.team', 'u.job_level')}))")
+
+
+def get_eligibility(email=None, course_id=None, visible_only=True):
+    """Attempt/retest status for (user, course) pairs, computed in one query.
+
+    Give `email` for one user across the courses they can see, `course_id` for every
+    active user who can see that course, or both for a single pair (pass
+    visible_only=False to skip the targeting check). Each row has attempt_count,
+    has_passed, has_retest_request, max_attempts, attempts_left, can_take and a
+    `status` of 'retest', 'passed', 'available' or 'exhausted'.
+    """
+    where, params = [], []
+    res_where, res_params = ["r.is_valid=1"], []  # same filters on results, so its indexes are used
+    if email is not None:
+        where.append("u.email=?"); params.append(email)
+        res_where.append("r.user_email=?"); res_params.append(email)
+    else:
+        where.append("u.status='active' AND u.verified=1")
+    if course_id is not None:
+        where.append("c.id=?"); params.append(course_id)
+        res_where.append("r.course_id=?"); res_params.append(course_id)
+    if visible_only:
+        where.append(USER_SEES_COURSE)
+    rows = get_db().execute(f"""
+        WITH pairs AS (
+            SELECT u.email, u.name, u.role, u.department, u.team, c.id AS course_id,
+                   COALESCE(c.max_attempts, 3) AS max_attempts
+            FROM users u JOIN courses c WHERE {' AND '.join(where)}
+        ), attempts AS (
+            SELECT r.user_email, r.course_id, COUNT(*) AS attempt_count, MAX(r.passed) AS has_passed,
+                   MAX(r.completed_at) AS last_completed
+            FROM results r WHERE {' AND '.join(res_where)} GROUP BY r.user_email, r.course_id
+        )
+        SELECT p.email, p.name, p.role, p.course_id, p.max_attempts,
+               COALESCE(a.attempt_count, 0) AS attempt_count, COALESCE(a.has_passed, 0) AS has_passed,
+               EXISTS (SELECT 1 FROM retest_requests t
+                       WHERE t.course_id=p.course_id
+                         AND t.created_at > COALESCE(a.last_completed, '2000-01-01')
+                         AND (t.target_type='all'
+                              OR (t.target_type='individual' AND t.target_value=p.email)
+                              OR (t.target_type='department' AND t.target_value=p.department)
+                              OR (t.target_type='team' AND t.target_value=p.team))) AS has_retest_request
+        FROM pairs p LEFT JOIN attempts a ON a.user_email=p.email AND a.course_id=p.course_id""",
+        params + res_params).fetchall()
+    result = []
+    for r in rows:
+        e = dict(r, has_passed=bool(r['has_passed']), has_retest_request=bool(r['has_retest_request']))
+        if e['has_retest_request']:
+            e.update(status='retest', attempts_left=e['max_attempts'])  # a retest starts the count again
+        else:
+            e['attempts_left'] = max(e['max_attempts'] - e['attempt_count'], 0)
+            e['status'] = 'passed' if e['has_passed'] else 'available' if e['attempts_left'] else 'exhausted'
+        e['can_take'] = e['status'] in ('retest', 'available')
+        result.append(e)
+    return result
 
 
 def get_user_attempt_info(email, course_id):
-    db = get_db()
-    valid = db.execute("SELECT * FROM results WHERE user_email=? AND course_id=? AND is_valid=1 ORDER BY completed_at DESC",
-                       (email, course_id)).fetchall()
-    has_passed = any(r['passed'] for r in valid)
-    has_retest = db.execute(
-        """SELECT id FROM retest_requests
-           WHERE course_id=? AND
-                 (
-                    target_type='all'
-                    OR (target_type='individual' AND target_value=?)
-                    OR (target_type='department' AND target_value=(SELECT department FROM users WHERE email=?))
-                    OR (target_type='team' AND target_value=(SELECT team FROM users WHERE email=?))
-                 )
-           AND created_at > COALESCE(
-                (SELECT MAX(completed_at) FROM results WHERE user_email=? AND course_id=? AND is_valid=1),
-                '2000-01-01'
-           )
-        """,
-        (course_id, email, email, email, email, course_id),
-    ).fetchone()
-    return {'attempt_count': len(valid), 'has_passed': has_passed,
-            'has_retest_request': has_retest is not None, 'results': valid}
+    """Eligibility of one user for one course, plus their valid results (newest first)."""
+    rows = get_eligibility(email, course_id, visible_only=False)
+    info = rows[0] if rows else {'attempt_count': 0, 'has_passed': False, 'has_retest_request': False,
+                                 'can_take': False, 'status': 'exhausted', 'attempts_left': 0}
+    info['results'] = get_db().execute(
+        "SELECT * FROM results WHERE user_email=? AND course_id=? AND is_valid=1 ORDER BY completed_at DESC",
+        (email, course_id)).fetchall()
+    return info
+
+
+TARGET_TYPES = ('department', 'team', 'job_level')
+
+
+def course_targets_from_form():
+    """(target_type, value) pairs from the course form checkboxes."""
+    return ([('department', v) for v in request.form.getlist('target_groups')] +
+            [('team', v) for v in request.form.getlist('target_teams')] +
+            [('job_level', v) for v in request.form.getlist('target_levels')])
+
+
+def save_course_targets(db, cid, targets):
+    """Replace a course's targets and refresh the department-only target_groups mirror (caller commits)."""
+    db.execute("DELETE FROM course_targets WHERE course_id=?", (cid,))
+    db.executemany("INSERT OR IGNORE INTO course_targets (course_id,target_type,value) VALUES (?,?,?)",
+                   [(cid, t, v) for t, v in targets if t in TARGET_TYPES and v])
+    db.execute("UPDATE courses SET target_groups=? WHERE id=?",
+               (json.dumps([v for t, v in targets if t == 'department' and v]), cid))
+
+
+def get_course_targets(cid):
+    rows = get_db().execute("SELECT target_type, value FROM course_targets WHERE course_id=?", (cid,)).fetchall()
+    return {(r['target_type'], r['value']) for r in rows}
+
+
+def visibility_clause(user):
+    """SQL condition on `c.id` limiting courses to what the user may see.
+
+    Admins and trainers see everything; learners see courses targeting their
+    department, team or job level.
+    """
+    if user['role'] in ('admin', 'trainer'):
+        return '1=1', []
+    return (f"c.id IN ({targeted_course_ids('?', '?', '?')})",
+            [user['department'] or '', user['team'] or '', user['job_level'] or ''])
+
+
+def get_visible_courses(user, where='1=1', params=()):
+    """Courses the user may see, filtered in SQL."""
+    vis_sql, vis_params = visibility_clause(user)
+    params = (*params, *vis_params)
+    return cached(('visible', where, params), lambda: tuple(get_db().execute(
+        f"SELECT c.* FROM courses c WHERE {where} AND {vis_sql} ORDER BY c.created_at DESC", params).fetchall()))
+
+
+def build_fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix.
+
+    Each 'd' is also tried as 'đ' because the tokenizer does not fold that letter.
+    """
+    words = re.findall(r'\w+', text.lower().replace('đ', 'd'))[:8]
+    terms = []
+    for i, word in enumerate(words):
+        star = '*' if i == len(words) - 1 else ''
+        variants = {word}
+        for _ in range(min(word.count('d'), 3)):
+            variants |= {v[:j] + 'đ' + v[j + 1:] for v in variants for j, ch in enumerate(v) if ch == 'd'}
+        terms.append('(' + ' OR '.join(f'"{v}"{star}' for v in sorted(variants)) + ')')
+    return ' AND '.join(terms)
+
+
+def render_snippet(raw):
+    """Escape an FTS snippet and turn its \x01/\x02 markers into <mark> tags."""
+    if not raw:
+        return ''
+    return Markup(str(escape(raw)).replace('\x01', '<mark>').replace('\x02', '</mark>'))
+
+
+def search_visible_courses(user, text, category=''):
+    """Ranked full-text search over course text and question text.
+
+    Courses matching on their own text always rank above courses found only through
+    a question (bm25 scores are negative and far smaller than the 1000 offset). Question
+    text only matches and ranks: those hits carry no snippet, so the page shows the course
+    description instead of leaking quiz questions.
+    """
+    fts_query = build_fts_query(text)
+    if not fts_query:
+        return get_visible_courses(user, "c.category=?" if category else "1=1", [category] if category else [])
+    vis_sql, vis_params = visibility_clause(user)
+    where, params = vis_sql, list(vis_params)
+    if category:
+        where += " AND c.category=?"; params.append(category)
+    rows = get_db().execute(f"""
+        WITH hits AS (
+            SELECT rowid AS course_id, bm25(course_fts, 10.0, 10.0, 3.0, 3.0) AS rank,
+                   snippet(course_fts, -1, char(1), char(2), '…', 16) AS snippet
+            FROM course_fts WHERE course_fts MATCH ?
+            UNION ALL
+            SELECT course_id, 1000.0 + bm25(question_fts) AS rank, NULL AS snippet
+            FROM question_fts WHERE question_fts MATCH ?
+        )
+        SELECT c.*, MIN(h.rank) AS rank, h.snippet AS snippet
+        FROM hits h JOIN courses c ON c.id=h.course_id
+        WHERE {where}
+        GROUP BY c.id ORDER BY rank LIMIT 200""", [fts_query, fts_query, *params]).fetchall()
+    return [dict(r, snippet=render_snippet(r['snippet'])) for r in rows]
+
+
+# ─────────── STATS ROLLUPS ───────────
+def get_rollup(dim):
+    """{key: {'attempts', 'passes', 'certs', 'rate'}} for one rollup dimension."""
+    rows = get_db().execute("SELECT key, attempts, passes, certs FROM stats_rollup WHERE dim=?", (dim,)).fetchall()
+    return {r['key']: {'attempts': r['attempts'], 'passes': r['passes'], 'certs': r['certs'],
+                       'rate': round(r['passes'] / r['attempts'] * 100) if r['attempts'] else 0}
+            for r in rows}
+
+
+# ─────────── RESULT HISTORY ───────────
+HISTORY_SELECT = '''SELECT r.id, r.user_email, u.name, COALESCE(r.department, u.department) AS department,
+        COALESCE(r.team, u.team) AS team, r.course_id, c.title_vi, c.title_en, c.category,
+        r.score, r.total, r.passed, r.attempt_number, r.completed_at
+    FROM results r LEFT JOIN users u ON r.user_email=u.email LEFT JOIN courses c ON r.course_id=c.id'''
+
+
+def history_filters(args):
+    """WHERE clause + params for valid results, from request args.
+
+    Supported: user (email or name prefix), department, team, course_id, category,
+    passed (1/0), date_from / date_to (YYYY-MM-DD, inclusive).
+    """
+    where, params = ["r.is_valid=1"], []
+    if args.get('user'):
+        where.append("r.user_email IN (SELECT email FROM users WHERE email LIKE ? OR name LIKE ?)")
+        params += [args['user'].strip().lower() + '%', args['user'].strip() + '%']
+    if args.get('department'):
+        where.append("r.department=?"); params.append(args['department'])
+    if args.get('team'):
+        where.append("r.team=?"); params.append(args['team'])
+    if str(args.get('course_id', '')).isdigit():
+        where.append("r.course_id=?"); params.append(int(args['course_id']))
+    if args.get('category'):
+        where.append("c.category=?"); params.append(args['category'])
+    if args.get('passed') in ('0', '1'):
+        where.append("r.passed=?"); params.append(int(args['passed']))
+    if args.get('date_from'):
+        where.append("r.completed_at >= ?"); params.append(args['date_from'])
+    if args.get('date_to'):
+        where.append("r.completed_at < date(?, '+1 day')"); params.append(args['date_to'])
+    return ' AND '.join(where), params
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(f"{row['completed_at']}|{row['id']}".encode()).decode()
+
+
+def decode_cursor(token):
+    """(completed_at, id) from a cursor token, or None if it is missing or malformed."""
+    try:
+        completed_at, rid = base64.urlsafe_b64decode(token.encode()).decode().rsplit('|', 1)
+        return completed_at, int(rid)
+    except Exception:
+        return None
+
+
+# ─────────── CONTENT CACHE ───────────
+class LRUCache:
+    """Small thread-safe LRU map tagged with the content_version it was filled at."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def sync(self, version):
+        """Drop everything if another process (or this one) changed content since we filled it."""
+        with self.lock:
+            if version != self.version:
+                self.data.clear()
+                self.version = version
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                return self.data[key]
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+CONTENT_CACHE = LRUCache(CONTENT_CACHE_SIZE)
+
+
+def content_cache():
+    """The per-process content cache, validated against content_version once per request."""
+    if 'content_version' not in g:
+        row = get_db().execute("SELECT value FROM settings WHERE key='content_version'").fetchone()
+        g.content_version = row['value'] if row else None
+        CONTENT_CACHE.sync(g.content_version)
+    return CONTENT_CACHE
+
+
+def cached(key, load):
+    cache = content_cache()
+    value = cache.get(key)
+    if value is None:
+        value = load()
+        if value is not None:
+            cache.put(key, value)
+    return value
+
+
+def get_course(cid):
+    return cached(('course', cid),
+                  lambda: get_db().execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone())
+
+
+# ─────────── QUESTION BANK ───────────
+def get_question_bank(cid):
+    """All questions of a course in one query, shared across requests until content changes."""
+    return cached(('bank', cid), lambda: tuple(
+        get_db().execute("SELECT * FROM questions WHERE course_id=? ORDER BY id", (cid,)).fetchall()))
+
+
+def get_questions(cid, qids):
+    """Questions of course `cid` for the given ids, in that order. Unknown ids are dropped."""
+    by_id = {q['id']: q for q in get_question_bank(cid)}
+    return [by_id[int(i)] for i in qids if str(i).isdigit() and int(i) in by_id]
+
+
+# ─────────── QUESTION IMPORT ───────────
+QUESTION_FIELDS = ('text', 'option_a', 'option_b', 'option_c', 'option_d', 'answer', 'explanation')
+QUESTION_ALIASES = {'question': 'text', 'a': 'option_a', 'b': 'option_b', 'c': 'option_c', 'd': 'option_d',
+                    'correct': 'answer'}
+QUESTION_INSERT = """INSERT INTO questions (course_id,text,option_a,option_b,option_c,option_d,answer,explanation,source)
+                     VALUES (?,?,?,?,?,?,?,?,?)"""
+
+
+def question_hash(text, a, b, c, d):
+    """Hash of a question's wording, ignoring case and whitespace differences."""
+    joined = '\0'.join(str(v or '').strip() for v in (text, a, b, c, d))  # NUL is not whitespace, so fields stay apart
+    return hashlib.sha256(' '.join(joined.split()).casefold().encode()).hexdigest()
+
+
+def detect_import_format(filename, head):
+    """'json', 'pipe' or 'csv' from the file extension or the first bytes of the input.
+
+    Text input is pipe-delimited when its first row splits into more fields on '|' than
+    on ',' (quotes respected), so a CSV whose question text contains '|' stays CSV.
+    """
+    if (filename or '').lower().endswith('.json') or head.lstrip()[:1] in ('[', '{'):
+        return 'json'
+    first = head.lstrip('\r\n').split('\n', 1)[0].rstrip('\r')
+    fields = {d: len(next(csv.reader([first], delimiter=d), [])) for d in (',', '|')}
+    return 'pipe' if fields['|'] > fields[','] else 'csv'
+
+
+def question_field(key):
+    """Canonical field for a column/key name ('Question', 'option A', 'b' ...), or None."""
+    field = str(key).strip().lower().replace(' ', '_')
+    field = QUESTION_ALIASES.get(field, field)
+    return field if field in QUESTION_FIELDS else None
+
+
+def map_question_fields(item):
+    return {question_field(k): v for k, v in item.items() if question_field(k)}
+
+
+def iter_question_rows(stream, fmt):
+    """Yield (line_no, row dict or None) from a text stream. JSON items are numbered from 1."""
+    if fmt == 'json':
+        data = json.load(stream)
+        items = data.get('questions', []) if isinstance(data, dict) else data
+        for n, item in enumerate(items if isinstance(items, list) else [], 1):
+            if not isinstance(item, dict):
+                yield n, None
+                continue
+            if isinstance(item.get('options'), list):
+                item = dict(item, **dict(zip(QUESTION_FIELDS[1:5], item['options'])))
+            yield n, map_question_fields(item)
+    elif fmt == 'csv':
+        reader = csv.reader(stream)
+        header = None
+        for parts in reader:
+            if not any(p.strip() for p in parts):
+                continue
+            if header is None and reader.line_num == 1 and 'text' in map(question_field, parts):
+                header = [question_field(p) for p in parts]
+                continue
+            keys = header or QUESTION_FIELDS
+            yield reader.line_num, {k: v.strip() for k, v in zip(keys, parts) if k in QUESTION_FIELDS}
+    else:
+        for n, line in enumerate(stream, 1):
+            if line.strip():
+                yield n, dict(zip(QUESTION_FIELDS, (p.strip() for p in line.rstrip('\r\n').split('|'))))
+
+
+def validate_question(row):
+    """(values, None) ready for QUESTION_INSERT, or (None, error message)."""
+    if not row:
+        return None, 'không đọc được dòng'
+    values = {f: str(row.get(f) or '').strip() for f in QUESTION_FIELDS}
+    if not values['text']:
+        return None, 'thiếu nội dung câu hỏi'
+    if not values['option_a'] or not values['option_b']:
+        return None, 'cần ít nhất đáp án A và B'
+    answer = values['answer'].lower()
+    answer = {'1': 'a', '2': 'b', '3': 'c', '4': 'd'}.get(answer, answer)
+    if answer not in ('a', 'b', 'c', 'd'):
+        return None, f'đáp án "{values["answer"]}" không hợp lệ (a/b/c/d)'
+    if not values[f'option_{answer}']:
+        return None, f'đáp án {answer.upper()} đang để trống'
+    values['answer'] = answer
+    return tuple(values[f] for f in QUESTION_FIELDS), None
+
+
+def import_questions(db, cid, rows, source='csv'):
+    """Validate, dedupe and insert question rows in a single transaction.
+
+    Rows matching an existing question of the course (or an earlier row) by question_hash
+    are skipped, so re-running an import is harmless. Returns the per-line report.
+    """
+    seen = {question_hash(*q) for q in db.execute(
+        "SELECT text, option_a, option_b, option_c, option_d FROM questions WHERE course_id=?", (cid,))}
+    report = {'rows': 0, 'imported': 0, 'duplicates': [], 'errors': []}
+    batch = []
+    for line, row in rows:
+        report['rows'] += 1
+        values, error = validate_question(row)
+        if error:
+            report['errors'].append({'line': line, 'error': error})
+            continue
+        digest = question_hash(*values[:5])
+        if digest in seen:
+            report['duplicates'].append(line)
+            continue
+        seen.add(digest)
+        batch.append((cid, *values, source))
+    try:
+        db.executemany(QUESTION_INSERT, batch)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    report['imported'] = len(batch)
+    return report
 
 
 def get_course_trainer(course):
-    """Get trainer info for certificate."""
+    """Get trainer info for certificate. The signature is a blob hash, rendered as a /blobs/ URL."""
     if not course or not course['created_by']:
         return None
+    return get_db().execute("SELECT id, email, name, job_title, signature_hash FROM users WHERE email=?",
+                            (course['created_by'],)).fetchone()
+
+
+# ─────────── CERTIFICATE RENDERING ───────────
+# Certificates are rendered server-side to a standalone SVG (vector, prints cleanly, keeps
+# Vietnamese text) and cached on disk per result. Bump the version when the layout changes.
+CERT_TEMPLATE_VERSION = 1
+CERT_RENDER_WORKERS = int(os.environ.get('CERT_RENDER_WORKERS', '4'))  # thread pool for bulk ZIP exports
+CERT_CACHE_DIR = os.environ.get('CERT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'certs'))
+
+
+def certificate_path(rid):
+    return os.path.join(CERT_CACHE_DIR, f'v{CERT_TEMPLATE_VERSION}', f'{rid}.svg')
+
+
+def certificate_filename(user_name, rid):
+    return f"Certificate_{(user_name or 'MANI').replace(' ', '_')}_{rid}.svg"
+
+
+def load_certificate_data(result, user=None, memo=None):
+    """Everything the renderer needs for one result, as plain values (safe to hand to a thread).
+
+    `memo` (a dict) shares the trainer lookup between results of the same course.
+    """
     db = get_db()
-    return db.execute("SELECT * FROM users WHERE email=?", (course['created_by'],)).fetchone()
+    if user is None:
+        user = db.execute("SELECT name, department FROM users WHERE email=?", (result['user_email'],)).fetchone()
+    course = get_course(result['course_id'])
+    memo = {} if memo is None else memo
+    if result['course_id'] not in memo:
+        trainer = get_course_trainer(course)
+        signature = None
+        if trainer and trainer['signature_hash']:
+            blob = db.execute("SELECT content_type, data FROM blobs WHERE hash=?", (trainer['signature_hash'],)).fetchone()
+            if blob:
+                signature = f"data:{blob['content_type']};base64,{base64.b64encode(blob['data']).decode()}"
+        memo[result['course_id']] = trainer, signature
+    trainer, signature = memo[result['course_id']]
+    # the department at completion time (results snapshot) picks the signing manager
+    manager = get_manager_for_department(result['department'] or (user['department'] if user else None))
+    return {
+        'rid': result['id'],
+        'name': user['name'] if user else result['user_email'],
+        'course': (course['title_vi'] or course['title_en']) if course else '',
+        'score': result['score'], 'total': result['total'],
+        'date': (result['completed_at'] or '')[:10],
+        'trainer_name': trainer['name'] if trainer else 'Trainer',
+        'trainer_title': (trainer['job_title'] if trainer else None) or 'Trainer',
+        'trainer_signature': signature,
+        'manager_name': manager['name'] if manager else 'Manager',
+        'manager_title': manager['title'] if manager else 'MANI Medical Hanoi',
+        'manager_signature': manager['signature_url'] if manager else '',
+    }
+
+
+def render_certificate_svg(d):
+    """The certificate as SVG text. Pure function of `d` (see load_certificate_data)."""
+    def text(x, y, value, size, fill, weight='normal', family='Segoe UI,Arial,sans-serif'):
+        return (f'<text x="{x}" y="{y}" font-size="{size}" fill="{fill}" font-weight="{weight}" '
+                f'font-family="{family}" text-anchor="middle">{escape(value)}</text>')
+
+    def image(x, y, href):
+        return f'<image x="{x}" y="{y}" width="170" height="60" href="{escape(href)}" preserveAspectRatio="xMidYMax meet"/>'
+
+    ratio = d['score'] / d['total'] if d['total'] else 0
+    serif = 'Georgia,serif'
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="900" height="660" viewBox="0 0 900 660">',
+        '<rect width="900" height="660" fill="#fff"/>',
+        '<rect x="10" y="10" width="880" height="640" fill="none" stroke="#003047" stroke-width="6"/>',
+        '<rect x="16" y="16" width="868" height="628" fill="none" stroke="#FFE100" stroke-width="2"/>',
+        *(f'<circle cx="{x}" cy="{y}" r="7" fill="#003047"/>' for x, y in ((22, 22), (878, 22), (22, 638), (878, 638))),
+        text(450, 58, 'MANI MEDICAL HANOI', 13, '#3A7595', '600'),
+        '<rect x="200" y="68" width="500" height="3" fill="#FFE100"/>',
+        text(450, 105, 'CHỨNG CHỈ HOÀN THÀNH ĐÀO TẠO', 26, '#003047', 'bold', serif),
+        text(450, 130, 'CERTIFICATE OF COMPLETION', 17, '#3A7595', 'bold', serif),
+        '<rect x="250" y="142" width="400" height="3" fill="#FFE100"/>',
+        text(450, 175, 'Chứng nhận rằng / This is to certify that', 14, '#555'),
+        text(450, 218, d['name'], 32, '#003047', 'bold', serif),
+        text(450, 260, 'Đã hoàn thành / Has completed', 14, '#555'),
+        text(450, 294, f'"{d["course"]}"', 20, '#3A7595', 'bold', serif),
+        text(450, 336, f'Điểm / Score: {d["score"]}/{d["total"]}', 18, '#333', '600'),
+        '<rect x="350" y="352" width="200" height="10" rx="5" fill="#E0E0E0"/>',
+        f'<rect x="350" y="352" width="{200 * ratio:.1f}" height="10" rx="5" fill="#28A745"/>',
+        text(450, 395, f'Ngày / Date: {d["date"]}', 13, '#777'),
+        '<rect x="200" y="418" width="500" height="3" fill="#FFE100"/>',
+        image(180, 436, d['trainer_signature']) if d['trainer_signature'] else '',
+        image(550, 436, d['manager_signature']) if d['manager_signature'] else '',
+        '<rect x="180" y="500" width="170" height="1" fill="#ccc"/><rect x="550" y="500" width="170" height="1" fill="#ccc"/>',
+        text(265, 520, d['trainer_name'], 13, '#003047', 'bold'),
+        text(265, 536, d['trainer_title'], 11, '#888'),
+        text(635, 520, d['manager_name'], 13, '#003047', 'bold'),
+        text(635, 536, d['manager_title'], 11, '#888'),
+        text(450, 580, 'MANI MEDICAL HANOI  •  Learning & Certification Platform', 10, '#003047', 'bold'),
+        '</svg>',
+    ]
+    return ''.join(parts)
+
+
+def write_certificate(d):
+    """Render `d` into the cache (atomically) unless it is already there. Returns the path."""
+    path = certificate_path(d['rid'])
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(render_certificate_svg(d))
+        os.replace(tmp, path)
+    return path
+
+
+def ensure_certificate(result, user=None):
+    """Path of the rendered certificate for a result; renders it on first use."""
+    path = certificate_path(result['id'])
+    if os.path.exists(path):
+        return path
+    return write_certificate(load_certificate_data(result, user))
 
 
 # ─────────── JINJA ───────────
@@ -544,8 +2305,7 @@ def register():
         job_title = request.form.get('job_title', 'Other')
         job_level = request.form.get('job_level', 'Staff')
 
-        allowed = get_allowed_emails()
-        if email not in allowed:
+        if not is_email_allowed(email):
             flash('Email không được phép đăng ký. Liên hệ Admin.', 'error')
             return render_template('register.html')
 
@@ -638,13 +2398,7 @@ def profile():
             file = request.files.get('avatar_file')
             if file and file.filename:
                 if allowed_avatar_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    # Ensure unique filename per user
-                    ext = filename.rsplit('.', 1)[1].lower()
-                    safe_name = f"user_{user['id']}_{int(datetime.now().timestamp())}.{ext}"
-                    save_path = os.path.join(app.config['AVATAR_UPLOAD_FOLDER'], safe_name)
-                    file.save(save_path)
-                    avatar_url = safe_name
+                    avatar_url = save_avatar(file)
                 else:
                     flash('Định dạng ảnh không hợp lệ. Chỉ chấp nhận PNG/JPG/JPEG/GIF.', 'error')
 
@@ -656,10 +2410,16 @@ def profile():
             session['user_name'] = name
             flash('Cập nhật hồ sơ thành công!', 'success')
         elif action == 'save_signature':
-            sig = request.form.get('signature_data', '')
-            db.execute("UPDATE users SET signature_data=? WHERE email=?", (sig, user['email']))
-            db.commit()
-            flash('Đã lưu chữ ký!', 'success')
+            blob = parse_data_url(request.form.get('signature_data', ''))
+            if blob:
+                digest = put_blob(db, *blob)
+                db.execute("UPDATE users SET signature_hash=?, signature_data=NULL WHERE id=?", (digest, user['id']))
+                if user['signature_hash'] != digest:
+                    drop_blob_if_unused(db, user['signature_hash'])
+                db.commit()
+                flash('Đã lưu chữ ký!', 'success')
+            else:
+                flash('Chữ ký không hợp lệ.', 'error')
         elif action == 'change_password':
             old_pw = request.form.get('old_password', '')
             new_pw = request.form.get('new_password', '')
@@ -673,14 +2433,58 @@ def profile():
                 db.commit()
                 flash('Đổi mật khẩu thành công!', 'success')
         return redirect(url_for('profile'))
-    user = get_current_user()  # refresh
     return render_template('profile.html', user=user)
 
 
+def save_avatar(file):
+    """Store an uploaded avatar under its content hash; identical uploads share one file."""
+    data = file.read()
+    ext = file.filename.rsplit('.', 1)[1].lower()  # already checked by allowed_avatar_file
+    name = f"{hashlib.sha256(data).hexdigest()[:32]}.{ext}"
+    path = os.path.join(app.config['AVATAR_UPLOAD_FOLDER'], name)
+    if not os.path.exists(path):
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return name
+
+
 @app.route('/avatars/<path:filename>')
 def avatar_file(filename):
-    """Serve uploaded avatar images."""
-    return send_from_directory(app.config['AVATAR_UPLOAD_FOLDER'], filename)
+    """Serve uploaded avatar images with long-lived caching and a content-hash ETag."""
+    etag = filename.rsplit('.', 1)[0]
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    elif AVATAR_ACCEL_PREFIX or AVATAR_X_SENDFILE:
+        path = safe_join(app.config['AVATAR_UPLOAD_FOLDER'], filename)
+        if not path or not os.path.isfile(path):
+            abort(404)
+        resp = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if AVATAR_ACCEL_PREFIX:
+            resp.headers['X-Accel-Redirect'] = f"{AVATAR_ACCEL_PREFIX.rstrip('/')}/{filename}"
+        else:
+            resp.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        resp = send_from_directory(app.config['AVATAR_UPLOAD_FOLDER'], filename, etag=False)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = f'public, max-age={AVATAR_MAX_AGE}, immutable'
+    return resp
+
+
+@app.route('/blobs/<digest>')
+def blob_file(digest):
+    """Serve a stored blob. The URL is the content hash, so it can be cached forever."""
+    if request.if_none_match.contains(digest):
+        resp = Response(status=304)
+    else:
+        row = get_db().execute("SELECT content_type, data FROM blobs WHERE hash=?", (digest,)).fetchone()
+        if not row:
+            abort(404)
+        resp = Response(bytes(row['data']), mimetype=row['content_type'])
+    resp.set_etag(digest)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
 
 
 # ═══════════════════ DASHBOARD ═══════════════════
@@ -689,19 +2493,11 @@ def avatar_file(filename):
 def dashboard():
     user = get_current_user()
     db = get_db()
-    courses = db.execute("SELECT * FROM courses ORDER BY created_at DESC").fetchall()
-    my_results = db.execute("SELECT * FROM results WHERE user_email=? AND is_valid=1", (user['email'],)).fetchall()
-    passed_ids = set(r['course_id'] for r in my_results if r['passed'])
-    visible = []
-    for c in courses:
-        groups = json.loads(c['target_groups'] or '[]')
-        if user['role'] in ('admin', 'trainer') or user['department'] in groups:
-            visible.append(c)
-    q_counts = {}
-    for c in visible:
-        q_counts[c['id']] = db.execute("SELECT COUNT(*) as cnt FROM questions WHERE course_id=?", (c['id'],)).fetchone()['cnt']
+    visible = get_visible_courses(user)
+    eligibility = {e['course_id']: e for e in get_eligibility(user['email'])}
+    passed_ids = {cid for cid, e in eligibility.items() if e['has_passed']}
     return render_template('dashboard.html', user=user, courses=visible,
-                           passed_ids=passed_ids, results=my_results, q_counts=q_counts)
+                           passed_ids=passed_ids, eligibility=eligibility)
 
 
 # ═══════════════════ CATEGORY & SEARCH ═══════════════════
@@ -710,12 +2506,10 @@ def dashboard():
 def browse_category(cat):
     user = get_current_user()
     db = get_db()
-    courses = db.execute("SELECT * FROM courses WHERE category=? ORDER BY created_at DESC", (cat,)).fetchall()
-    visible = [c for c in courses if user['role'] in ('admin','trainer') or user['department'] in json.loads(c['target_groups'] or '[]')]
+    visible = get_visible_courses(user, "c.category=?", (cat,))
     my_results = db.execute("SELECT * FROM results WHERE user_email=? AND is_valid=1", (user['email'],)).fetchall()
     passed_ids = set(r['course_id'] for r in my_results if r['passed'])
-    q_counts = {c['id']: db.execute("SELECT COUNT(*) as cnt FROM questions WHERE course_id=?", (c['id'],)).fetchone()['cnt'] for c in visible}
-    return render_template('category.html', user=user, courses=visible, category=cat, passed_ids=passed_ids, q_counts=q_counts)
+    return render_template('category.html', user=user, courses=visible, category=cat, passed_ids=passed_ids)
 
 @app.route('/search')
 @login_required
@@ -724,19 +2518,11 @@ def search_courses():
     db = get_db()
     q = request.args.get('q', '').strip()
     cat = request.args.get('category', '')
-    sql, params = "SELECT * FROM courses WHERE 1=1", []
-    if q:
-        sql += " AND (title_vi LIKE ? OR title_en LIKE ? OR desc_vi LIKE ? OR desc_en LIKE ?)"
-        params.extend([f'%{q}%'] * 4)
-    if cat:
-        sql += " AND category=?"; params.append(cat)
-    courses = db.execute(sql + " ORDER BY created_at DESC", params).fetchall()
-    visible = [c for c in courses if user['role'] in ('admin','trainer') or user['department'] in json.loads(c['target_groups'] or '[]')]
+    visible = search_visible_courses(user, q, cat)
     my_results = db.execute("SELECT * FROM results WHERE user_email=? AND is_valid=1", (user['email'],)).fetchall()
     passed_ids = set(r['course_id'] for r in my_results if r['passed'])
-    q_counts = {c['id']: db.execute("SELECT COUNT(*) as cnt FROM questions WHERE course_id=?", (c['id'],)).fetchone()['cnt'] for c in visible}
     return render_template('search.html', user=user, courses=visible, query=q, filter_cat=cat,
-                           passed_ids=passed_ids, q_counts=q_counts)
+                           passed_ids=passed_ids)
 
 
 # ═══════════════════ COURSE DETAIL & QUIZ ═══════════════════
@@ -745,24 +2531,24 @@ def search_courses():
 def course_detail(cid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     if not course:
         flash('Khóa học không tồn tại.', 'error'); return redirect(url_for('dashboard'))
-    q_count = db.execute("SELECT COUNT(*) as cnt FROM questions WHERE course_id=?", (cid,)).fetchone()['cnt']
+    q_count = course['question_count']
     attempt_info = get_user_attempt_info(user['email'], cid)
     embed_url = get_youtube_embed(course['video_url'])
     max_att = course['max_attempts'] or 3
-    can_take_quiz = attempt_info['has_retest_request'] or (not attempt_info['has_passed'] and attempt_info['attempt_count'] < max_att)
     return render_template('course_detail.html', user=user, course=course, q_count=q_count,
-                           attempt_info=attempt_info, embed_url=embed_url, can_take_quiz=can_take_quiz, max_attempts=max_att)
+                           attempt_info=attempt_info, embed_url=embed_url, can_take_quiz=attempt_info['can_take'],
+                           max_attempts=max_att)
 
 @app.route('/quiz/<int:cid>', methods=['GET', 'POST'])
 @login_required
 def take_quiz(cid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
-    all_questions = db.execute("SELECT * FROM questions WHERE course_id=?", (cid,)).fetchall()
+    course = get_course(cid)
+    all_questions = get_question_bank(cid)
     if not course or not all_questions:
         flash('Không có câu hỏi.', 'error'); return redirect(url_for('course_detail', cid=cid))
     attempt_info = get_user_attempt_info(user['email'], cid)
@@ -776,8 +2562,7 @@ def take_quiz(cid):
 
     if request.method == 'POST':
         q_ids = [qid.strip() for qid in request.form.get('question_ids', '').split(',') if qid.strip()]
-        questions = [db.execute("SELECT * FROM questions WHERE id=?", (int(qid),)).fetchone() for qid in q_ids]
-        questions = [q for q in questions if q]
+        questions = get_questions(cid, q_ids)
         score, answers = 0, {}
         for q in questions:
             ans = request.form.get(f'q_{q["id"]}', '')
@@ -787,15 +2572,21 @@ def take_quiz(cid):
         if attempt_info['has_retest_request']:
             db.execute("UPDATE results SET is_valid=0 WHERE user_email=? AND course_id=?", (user['email'], cid))
         new_att = 1 if attempt_info['has_retest_request'] else attempt_info['attempt_count'] + 1
-        db.execute("INSERT INTO results (user_email,course_id,score,total,passed,answers_json,attempt_number) VALUES (?,?,?,?,?,?,?)",
-                   (user['email'], cid, score, len(questions), passed, json.dumps(answers), new_att))
+        db.execute("""INSERT INTO results (user_email,course_id,score,total,passed,answers_json,attempt_number,department,team)
+                      VALUES (?,?,?,?,?,?,?,?,?)""",
+                   (user['email'], cid, score, len(questions), passed, json.dumps(answers), new_att,
+                    user['department'], user['team']))
         db.commit()
+        count_metric('lms_quiz_submissions_total')
         rid = db.execute("SELECT last_insert_rowid()").fetchone()[0]
         if passed:
             trainer = get_course_trainer(course)
+            result = db.execute("SELECT * FROM results WHERE id=?", (rid,)).fetchone()
             send_certificate_email(user['email'], user['name'], course['title_vi'] or course['title_en'],
                                    score, len(questions), datetime.now().strftime('%d/%m/%Y'),
-                                   trainer['name'] if trainer else '')
+                                   trainer['name'] if trainer else '',
+                                   (ensure_certificate(result, user), certificate_filename(user['name'], rid)),
+                                   url_for('cert_file', cid=cid, rid=rid, _external=True))
         return redirect(url_for('quiz_result', cid=cid, rid=rid))
 
     q_list = list(all_questions); random.shuffle(q_list)
@@ -806,12 +2597,11 @@ def take_quiz(cid):
 def quiz_result(cid, rid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     result = db.execute("SELECT * FROM results WHERE id=? AND user_email=?", (rid, user['email'])).fetchone()
     if not result: return redirect(url_for('course_detail', cid=cid))
     answers = json.loads(result['answers_json'] or '{}')
-    questions = [db.execute("SELECT * FROM questions WHERE id=?", (int(qid),)).fetchone() for qid in answers.keys()]
-    questions = [q for q in questions if q]
+    questions = get_questions(cid, answers.keys())
     attempt_info = get_user_attempt_info(user['email'], cid)
     return render_template('quiz_result.html', user=user, course=course, result=result,
                            questions=questions, answers=answers, attempt_info=attempt_info)
@@ -823,28 +2613,48 @@ def quiz_result(cid, rid):
 def download_cert(cid, rid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     result = db.execute("SELECT * FROM results WHERE id=? AND user_email=? AND passed=1", (rid, user['email'])).fetchone()
     if not course or not result:
         flash('Chứng chỉ không khả dụng.', 'error'); return redirect(url_for('dashboard'))
     trainer = get_course_trainer(course)
-    manager = get_manager_for_department(user['department'])
+    manager = get_manager_for_department(result['department'] or user['department'])
     return render_template('certificate.html', user=user, course=course, result=result,
                            trainer=trainer, manager=manager)
 
+@app.route('/certificate/<int:cid>/<int:rid>/file')
+@login_required
+def cert_file(cid, rid):
+    """The rendered certificate, served from the render cache (?download=1 to save it)."""
+    user = get_current_user()
+    db = get_db()
+    result = db.execute("SELECT * FROM results WHERE id=? AND course_id=? AND passed=1", (rid, cid)).fetchone()
+    if not result or (result['user_email'] != user['email'] and user['role'] not in ('admin', 'trainer')):
+        flash('Chứng chỉ không khả dụng.', 'error'); return redirect(url_for('dashboard'))
+    owner = user if result['user_email'] == user['email'] else \
+        db.execute("SELECT name, department FROM users WHERE email=?", (result['user_email'],)).fetchone()
+    resp = send_file(ensure_certificate(result, owner), mimetype='image/svg+xml',
+                     as_attachment=bool(request.args.get('download')),
+                     download_name=certificate_filename(owner['name'] if owner else None, rid), max_age=3600)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
+
 @app.route('/certificate/<int:cid>/<int:rid>/send-email', methods=['POST'])
 @login_required
 def send_cert_email(cid, rid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     result = db.execute("SELECT * FROM results WHERE id=? AND user_email=? AND passed=1", (rid, user['email'])).fetchone()
     if course and result:
         trainer = get_course_trainer(course)
         ok = send_certificate_email(user['email'], user['name'], course['title_vi'] or course['title_en'],
                                     result['score'], result['total'], (result['completed_at'] or '')[:10],
-                                    trainer['name'] if trainer else '')
-        flash('Đã gửi email!' if ok else 'Gửi email thất bại. Kiểm tra cấu hình SMTP.', 'success' if ok else 'error')
+                                    trainer['name'] if trainer else '',
+                                    (ensure_certificate(result, user), certificate_filename(user['name'], rid)),
+                                    url_for('cert_file', cid=cid, rid=rid, _external=True))
+        flash('Email đã được xếp hàng gửi!' if ok else 'Gửi email thất bại. Kiểm tra cấu hình SMTP.', 'success' if ok else 'error')
     return redirect(url_for('download_cert', cid=cid, rid=rid))
 
 @app.route('/my-certs')
@@ -867,19 +2677,20 @@ def my_certs():
 def admin_panel():
     user = get_current_user()
     db = get_db()
-    users = db.execute("SELECT * FROM users ORDER BY created_at DESC").fetchall()
-    courses = db.execute("SELECT * FROM courses ORDER BY created_at DESC").fetchall()
-    results = db.execute("SELECT * FROM results WHERE is_valid=1").fetchall()
-    q_counts = {c['id']: db.execute("SELECT COUNT(*) as cnt FROM questions WHERE course_id=?", (c['id'],)).fetchone()['cnt'] for c in courses}
+    users = db.execute(f"SELECT {USER_COLUMNS} FROM users ORDER BY created_at DESC").fetchall()
+    courses = get_visible_courses(user)
     allowed = db.execute("SELECT * FROM allowed_emails ORDER BY created_at DESC").fetchall()
+    totals = get_rollup('all').get('', {})
     stats = {
-        'total_users': len([u for u in users if u['role'] in ('learner', 'trainer')]),
+        'total_users': sum(1 for u in users if u['role'] in ('learner', 'trainer')),
         'total_courses': len(courses),
-        'total_certs': len(set(f"{r['user_email']}-{r['course_id']}" for r in results if r['passed'])),
-        'total_attempts': len(results)
+        'total_certs': totals.get('certs', 0),
+        'total_attempts': totals.get('attempts', 0),
     }
-    return render_template('admin.html', user=user, users=users, courses=courses, results=results,
-                           q_counts=q_counts, stats=stats, allowed_emails=allowed)
+    return render_template('admin.html', user=user, users=users, courses=courses,
+                           users_by_email={u['email']: u for u in users},
+                           stats=stats, allowed_emails=allowed,
+                           outbox=get_outbox_stats(), smtp_state=get_smtp_state())
 
 @app.route('/admin/user/<int:uid>/update', methods=['POST'])
 @admin_required
@@ -944,6 +2755,134 @@ def add_allowed_email():
         flash('Email không hợp lệ.', 'error')
     return redirect(url_for('admin_panel') + '#emails')
 
+# Column order for provisioning files without a header row
+PROVISION_FIELDS = ('email', 'name', 'department', 'team', 'job_title', 'job_level', 'password', 'note')
+
+
+def iter_provision_rows(stream):
+    """Yield (line_no, row dict) from CSV text; a header row naming the columns is optional."""
+    reader = csv.reader(stream)
+    header = None
+    for parts in reader:
+        if not any(p.strip() for p in parts):
+            continue
+        cells = [p.strip().lower().replace(' ', '_') for p in parts]
+        if header is None and reader.line_num == 1 and 'email' in cells:
+            header = cells
+            continue
+        yield reader.line_num, {k: v.strip() for k, v in zip(header or PROVISION_FIELDS, parts)
+                                if k in PROVISION_FIELDS and v.strip()}
+
+
+def provision_users(db, rows, added_by, deactivate_missing=False):
+    """Upsert whitelist entries (and accounts for rows with a password) in one transaction.
+
+    Rows are staged in a temp table and applied with set-based statements. With
+    deactivate_missing, whitelist entries and non-admin accounts absent from the upload
+    are disabled. Returns a report dict.
+    """
+    report = {'rows': 0, 'errors': [], 'whitelisted': 0, 'users_created': 0, 'users_updated': 0,
+              'deactivated_emails': 0, 'deactivated_users': 0}
+    staged, seen = [], {}  # email -> line it was first seen on
+    for line, row in rows:
+        report['rows'] += 1
+        email = row.get('email', '').lower()
+        if not re.fullmatch(r'[^@\s]+@[^@\s]+\.[^@\s]+', email):
+            report['errors'].append({'line': line, 'error': f'email không hợp lệ: {email or "(trống)"}'})
+            continue
+        if row.get('department') and row['department'] not in DEPARTMENTS:
+            report['errors'].append({'line': line, 'error': f'phòng ban không tồn tại: {row["department"]}'})
+            continue
+        if email in seen:
+            report['errors'].append({'line': line, 'error': f'email trùng với dòng {seen[email]}: {email}'})
+            continue
+        seen[email] = line
+        password = row.get('password')
+        if password and len(password) < 4:
+            report['errors'].append({'line': line, 'error': 'mật khẩu < 4 ký tự'})
+            continue
+        staged.append((email, row.get('note', ''), row.get('name'), row.get('department'), row.get('team'),
+                       row.get('job_title'), row.get('job_level'), hash_password(password) if password else None))
+    try:
+        db.execute("""CREATE TEMP TABLE IF NOT EXISTS provision (
+                          email TEXT PRIMARY KEY, note TEXT, name TEXT, department TEXT, team TEXT,
+                          job_title TEXT, job_level TEXT, password_hash TEXT)""")
+        db.execute("DELETE FROM temp.provision")
+        db.executemany("INSERT INTO temp.provision VALUES (?,?,?,?,?,?,?,?)", staged)
+        report['whitelisted'] = db.execute("""
+            INSERT INTO allowed_emails (email, note, added_by, active)
+            SELECT email, note, ?, 1 FROM temp.provision WHERE true
+            ON CONFLICT(email) DO UPDATE SET active=1,
+                note=CASE WHEN excluded.note!='' THEN excluded.note ELSE allowed_emails.note END""",
+            (added_by,)).rowcount
+        report['users_updated'] = db.execute("""
+            UPDATE users SET name=COALESCE(p.name, users.name), department=COALESCE(p.department, users.department),
+                team=COALESCE(p.team, users.team), job_title=COALESCE(p.job_title, users.job_title),
+                job_level=COALESCE(p.job_level, users.job_level),
+                password_hash=COALESCE(p.password_hash, users.password_hash),
+                verified=CASE WHEN p.password_hash IS NOT NULL THEN 1 ELSE users.verified END, status='active'
+            FROM temp.provision p WHERE users.email=p.email""").rowcount
+        report['users_created'] = db.execute("""
+            INSERT INTO users (email,password_hash,name,department,team,job_title,job_level,role,verified,status)
+            SELECT p.email, p.password_hash, COALESCE(p.name, p.email), COALESCE(p.department, ?),
+                   COALESCE(p.team, 'N/A'), COALESCE(p.job_title, 'Staff'), COALESCE(p.job_level, 'Staff'),
+                   'learner', 1, 'active'
+            FROM temp.provision p
+            WHERE p.password_hash IS NOT NULL AND NOT EXISTS (SELECT 1 FROM users u WHERE u.email=p.email)""",
+            (DEPARTMENTS[0],)).rowcount
+        if deactivate_missing and staged:
+            report['deactivated_emails'] = db.execute("""
+                UPDATE allowed_emails SET active=0
+                WHERE active=1 AND email NOT IN (SELECT email FROM temp.provision)""").rowcount
+            report['deactivated_users'] = db.execute("""
+                UPDATE users SET status='inactive'
+                WHERE status='active' AND role!='admin' AND email!=?
+                  AND email NOT IN (SELECT email FROM temp.provision)""", (added_by,)).rowcount
+        db.execute("DELETE FROM temp.provision")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return report
+
+
+@app.route('/admin/email/bulk', methods=['POST'])
+@admin_only
+def bulk_provision():
+    """Whitelist (and optionally create/update accounts for) many emails from CSV.
+
+    Columns: email,name,department,team,job_title,job_level,password,note (header optional).
+    deactivate_missing=1 disables whitelist entries and non-admin accounts not in the upload.
+    ?format=json returns the report instead of redirecting.
+    """
+    f = request.files.get('provision_file')
+    if f and f.filename:
+        stream = io.TextIOWrapper(f.stream, encoding='utf-8-sig', newline='')
+    else:
+        stream = io.StringIO(request.form.get('provision_data', ''), newline='')
+    user = get_current_user()
+    try:
+        report = provision_users(get_db(), iter_provision_rows(stream), user['email'],
+                                 request.form.get('deactivate_missing') == '1')
+    except (ValueError, csv.Error) as e:
+        if request.args.get('format') == 'json':
+            return jsonify(error=str(e)), 400
+        flash(f'Lỗi đọc dữ liệu: {e}', 'error')
+        return redirect(url_for('admin_panel') + '#emails')
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    msg = (f"Whitelist: {report['whitelisted']} email · tạo {report['users_created']} / "
+           f"cập nhật {report['users_updated']} tài khoản")
+    if report['deactivated_emails'] or report['deactivated_users']:
+        msg += f" · vô hiệu hóa {report['deactivated_emails']} email, {report['deactivated_users']} tài khoản"
+    flash(msg, 'success' if not report['errors'] else 'warning')
+    for e in report['errors'][:10]:
+        flash(f"Dòng {e['line']}: {e['error']}", 'error')
+    if len(report['errors']) > 10:
+        flash(f"… và {len(report['errors']) - 10} lỗi khác", 'error')
+    return redirect(url_for('admin_panel') + '#emails')
+
+
 @app.route('/admin/email/<int:eid>/toggle', methods=['POST'])
 @admin_only
 def toggle_email(eid):
@@ -971,18 +2910,19 @@ def new_course():
     if request.method == 'POST':
         db = get_db()
         db.execute('''INSERT INTO courses (title_vi,title_en,desc_vi,desc_en,category,video_url,pdf_url,
-                      target_groups,deadline,pass_score,quiz_count,time_limit,max_attempts,created_by)
-                      VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                      deadline,pass_score,quiz_count,time_limit,max_attempts,created_by)
+                      VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)''',
                    (request.form.get('title_vi',''), request.form.get('title_en',''),
                     request.form.get('desc_vi',''), request.form.get('desc_en',''),
                     request.form.get('category','Compliance'),
                     request.form.get('video_url',''), request.form.get('pdf_url',''),
-                    json.dumps(request.form.getlist('target_groups')), request.form.get('deadline',''),
+                    request.form.get('deadline',''),
                     int(request.form.get('pass_score',3)), int(request.form.get('quiz_count',0)),
                     int(request.form.get('time_limit',15)), int(request.form.get('max_attempts',3)),
                     user['email']))
-        db.commit()
         cid = db.execute("SELECT last_insert_rowid()").fetchone()[0]
+        save_course_targets(db, cid, course_targets_from_form())
+        db.commit()
         flash('Đã tạo khóa học!', 'success')
         return redirect(url_for('manage_questions', cid=cid))
     return render_template('course_form.html', user=user, course=None)
@@ -992,29 +2932,30 @@ def new_course():
 def edit_course(cid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     if not course: flash('Không tồn tại.', 'error'); return redirect(url_for('admin_panel'))
     if request.method == 'POST':
         db.execute('''UPDATE courses SET title_vi=?,title_en=?,desc_vi=?,desc_en=?,category=?,video_url=?,pdf_url=?,
-                      target_groups=?,deadline=?,pass_score=?,quiz_count=?,time_limit=?,max_attempts=? WHERE id=?''',
+                      deadline=?,pass_score=?,quiz_count=?,time_limit=?,max_attempts=? WHERE id=?''',
                    (request.form.get('title_vi',''), request.form.get('title_en',''),
                     request.form.get('desc_vi',''), request.form.get('desc_en',''),
                     request.form.get('category','Compliance'),
                     request.form.get('video_url',''), request.form.get('pdf_url',''),
-                    json.dumps(request.form.getlist('target_groups')), request.form.get('deadline',''),
+                    request.form.get('deadline',''),
                     int(request.form.get('pass_score',3)), int(request.form.get('quiz_count',0)),
                     int(request.form.get('time_limit',15)), int(request.form.get('max_attempts',3)), cid))
+        save_course_targets(db, cid, course_targets_from_form())
         db.commit()
         flash('Cập nhật thành công!', 'success')
         return redirect(url_for('admin_panel') + '#content')
-    q_count = db.execute("SELECT COUNT(*) as cnt FROM questions WHERE course_id=?", (cid,)).fetchone()['cnt']
-    return render_template('course_form.html', user=user, course=course, q_count=q_count)
+    return render_template('course_form.html', user=user, course=course, q_count=course['question_count'],
+                           targets=get_course_targets(cid))
 
 @app.route('/admin/course/<int:cid>/delete', methods=['POST'])
 @admin_required
 def delete_course(cid):
     db = get_db()
-    for t in ['questions','results','retest_requests']:
+    for t in ['questions','results','retest_requests','course_targets']:
         db.execute(f"DELETE FROM {t} WHERE course_id=?", (cid,))
     db.execute("DELETE FROM courses WHERE id=?", (cid,))
     db.commit()
@@ -1026,7 +2967,7 @@ def delete_course(cid):
 def manage_questions(cid):
     user = get_current_user()
     db = get_db()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     if not course: return redirect(url_for('admin_panel'))
     if request.method == 'POST':
         action = request.form.get('action')
@@ -1036,37 +2977,32 @@ def manage_questions(cid):
                         request.form.get('option_c',''), request.form.get('option_d',''),
                         request.form.get('answer','a'), request.form.get('explanation',''), 'manual'))
             db.commit(); flash('Đã thêm!', 'success')
-        elif action == 'csv':
-            count = 0
-            for line in request.form.get('csv_data','').strip().split('\n'):
-                if not line.strip(): continue
-                parts = [p.strip() for p in line.split('|')]
-                if len(parts) >= 6:
-                    ans = parts[5].strip().lower()
-                    if ans not in ('a','b','c','d'): ans = 'a'
-                    db.execute("INSERT INTO questions (course_id,text,option_a,option_b,option_c,option_d,answer,explanation,source) VALUES (?,?,?,?,?,?,?,?,?)",
-                               (cid, parts[0], parts[1], parts[2], parts[3] if len(parts)>3 else '', parts[4] if len(parts)>4 else '', ans, parts[6] if len(parts)>6 else '', 'csv'))
-                    count += 1
-            db.commit()
-            flash(f'Import {count} câu!' if count else 'Không tìm thấy câu hợp lệ.', 'success' if count else 'error')
-        elif action == 'csv_file':
+        elif action in ('csv', 'csv_file'):
             f = request.files.get('csv_file')
-            if f and f.filename:
-                try:
-                    content = f.read().decode('utf-8-sig')
-                    count = 0
-                    for line in content.strip().split('\n'):
-                        if not line.strip(): continue
-                        parts = [p.strip() for p in line.split('|')]
-                        if len(parts) >= 6:
-                            ans = parts[5].strip().lower()
-                            if ans not in ('a','b','c','d'): ans = 'a'
-                            db.execute("INSERT INTO questions (course_id,text,option_a,option_b,option_c,option_d,answer,explanation,source) VALUES (?,?,?,?,?,?,?,?,?)",
-                                       (cid, parts[0], parts[1], parts[2], parts[3] if len(parts)>3 else '', parts[4] if len(parts)>4 else '', ans, parts[6] if len(parts)>6 else '', 'csv'))
-                            count += 1
-                    db.commit()
-                    flash(f'Import {count} câu từ file!' if count else 'File không hợp lệ.', 'success' if count else 'error')
-                except Exception as e: flash(f'Lỗi: {e}', 'error')
+            if action == 'csv_file' and f and f.filename:
+                head = f.stream.read(4096).decode('utf-8-sig', errors='ignore')
+                f.stream.seek(0)
+                fmt = detect_import_format(f.filename, head)
+                stream = io.TextIOWrapper(f.stream, encoding='utf-8-sig', newline='')
+            else:
+                text = request.form.get('csv_data', '')
+                fmt = detect_import_format(None, text[:4096])
+                stream = io.StringIO(text, newline='')
+            try:
+                report = import_questions(db, cid, iter_question_rows(stream, fmt), source=fmt)
+            except (ValueError, csv.Error) as e:  # bad encoding / malformed JSON or CSV
+                report = None
+                flash(f'Lỗi đọc dữ liệu: {e}', 'error')
+            if request.args.get('format') == 'json':
+                return jsonify(report) if report else (jsonify(error='unreadable input'), 400)
+            if report:
+                n = report['imported']
+                flash(f"Import {n}/{report['rows']} câu ({fmt.upper()}): {len(report['duplicates'])} trùng, "
+                      f"{len(report['errors'])} lỗi.", 'success' if n and not report['errors'] else 'warning')
+                questions = db.execute("SELECT * FROM questions WHERE course_id=? ORDER BY created_at ASC", (cid,)).fetchall()
+                g.pop('content_version', None)  # the import bumped it: re-sync so the course shows the new question_count
+                return render_template('questions.html', user=user, course=get_course(cid), questions=questions,
+                                       import_report=report)
         elif action == 'delete':
             db.execute("DELETE FROM questions WHERE id=? AND course_id=?", (request.form.get('question_id'), cid))
             db.commit(); flash('Đã xóa.', 'success')
@@ -1092,36 +3028,30 @@ def request_retest(cid):
         (cid, tt, tv, user['email'], deadline),
     )
     db.commit()
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     ct = course['title_vi'] or course['title_en'] if course else ''
     if tt == 'all':
-        targets = db.execute("SELECT * FROM users WHERE role IN ('learner','trainer') AND verified=1 AND status='active'").fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE role IN ('learner','trainer') AND verified=1 AND status='active'").fetchall()
     elif tt == 'department':
-        targets = db.execute("SELECT * FROM users WHERE department=? AND verified=1 AND status='active'", (tv,)).fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE department=? AND verified=1 AND status='active'", (tv,)).fetchall()
     elif tt == 'team':
-        targets = db.execute("SELECT * FROM users WHERE team=? AND verified=1 AND status='active'", (tv,)).fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE team=? AND verified=1 AND status='active'", (tv,)).fetchall()
     else:
-        targets = db.execute("SELECT * FROM users WHERE email=? AND verified=1", (tv,)).fetchall()
-
-    sent = sum(
-        1 for t in targets
-        if send_retest_email(
-            t['email'],
-            t['name'],
-            ct,
-            deadline,
-            user['name'],
-        )
-    )
+        targets = db.execute("SELECT email, name FROM users WHERE email=? AND verified=1", (tv,)).fetchall()
+
+    sent = queue_emails([
+        (t['email'], *retest_email(t['name'], ct, deadline, user['name']))
+        for t in targets
+    ])
 
     if not targets:
         flash('Không tìm thấy learner phù hợp để gửi yêu cầu thi lại.', 'warning')
     elif sent == 0:
         flash('Gửi email thất bại. Vui lòng kiểm tra cấu hình SMTP (SMTP_SERVER, SMTP_USER, SMTP_PASS).', 'error')
     elif sent < len(targets):
-        flash(f'Yêu cầu thi lại: {len(targets)} người (chỉ gửi được {sent} email). Kiểm tra lại cấu hình SMTP.', 'warning')
+        flash(f'Yêu cầu thi lại: {len(targets)} người (chỉ xếp hàng được {sent} email). Kiểm tra lại cấu hình SMTP.', 'warning')
     else:
-        flash(f'Yêu cầu thi lại: {len(targets)} người ({sent} email gửi thành công).', 'success')
+        flash(f'Yêu cầu thi lại: {len(targets)} người ({sent} email đã xếp hàng gửi).', 'success')
     return redirect(url_for('manage_questions', cid=cid))
 
 @app.route('/admin/send-reminder', methods=['POST'])
@@ -1130,38 +3060,42 @@ def send_reminder():
     user = get_current_user()
     db = get_db()
     cid = request.form.get('course_id')
-    course = db.execute("SELECT * FROM courses WHERE id=?", (cid,)).fetchone()
+    course = get_course(cid)
     if not course: flash('Khóa học không tồn tại.', 'error'); return redirect(url_for('admin_panel'))
     ct = course['title_vi'] or course['title_en']
     tt, tv = request.form.get('target_type','all'), request.form.get('target_value','')
     deadline = request.form.get('deadline', '').strip()
     if tt == 'all':
-        targets = db.execute("SELECT * FROM users WHERE role IN ('learner','trainer') AND verified=1 AND status='active'").fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE role IN ('learner','trainer') AND verified=1 AND status='active'").fetchall()
     elif tt == 'department':
-        targets = db.execute("SELECT * FROM users WHERE department=? AND verified=1 AND status='active'", (tv,)).fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE department=? AND verified=1 AND status='active'", (tv,)).fetchall()
     elif tt == 'team':
-        targets = db.execute("SELECT * FROM users WHERE team=? AND verified=1 AND status='active'", (tv,)).fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE team=? AND verified=1 AND status='active'", (tv,)).fetchall()
+    elif tt == 'pending':
+        # everyone the course is assigned to who still has to pass it (or retake it)
+        targets = [e for e in get_eligibility(course_id=course['id'])
+                   if e['role'] != 'admin' and e['status'] in ('available', 'retest')]
     else:
-        targets = db.execute("SELECT * FROM users WHERE email=? AND verified=1", (tv,)).fetchall()
+        targets = db.execute("SELECT email, name FROM users WHERE email=? AND verified=1", (tv,)).fetchall()
 
     def build_msg(user_name):
         if deadline:
             return f'vui lòng hoàn thành bài đào tạo "{ct}" vào trước ngày {deadline}.'
         return f'vui lòng hoàn thành bài đào tạo "{ct}" trong thời gian sớm nhất.'
 
-    sent = sum(
-        1 for t in targets
-        if send_reminder_email(t['email'], t['name'], ct, build_msg(t['name']), user['name'])
-    )
+    sent = queue_emails([
+        (t['email'], *reminder_email(t['name'], ct, build_msg(t['name']), user['name']))
+        for t in targets
+    ])
 
     if not targets:
         flash('Không tìm thấy learner phù hợp để gửi email nhắc nhở.', 'warning')
     elif sent == 0:
         flash('Gửi email nhắc nhở thất bại. Vui lòng kiểm tra cấu hình SMTP (SMTP_SERVER, SMTP_USER, SMTP_PASS).', 'error')
     elif sent < len(targets):
-        flash(f'Đã gửi tới {len(targets)} người (chỉ {sent} email gửi thành công). Kiểm tra lại cấu hình SMTP.', 'warning')
+        flash(f'Đã gửi tới {len(targets)} người (chỉ {sent} email được xếp hàng). Kiểm tra lại cấu hình SMTP.', 'warning')
     else:
-        flash(f'Gửi {len(targets)} người ({sent} email OK).', 'success')
+        flash(f'Gửi {len(targets)} người ({sent} email đã xếp hàng).', 'success')
     return redirect(request.referrer or url_for('admin_panel'))
 
 
@@ -1171,37 +3105,171 @@ def send_reminder():
 def analytics():
     user = get_current_user()
     db = get_db()
-    users_all = db.execute("SELECT * FROM users").fetchall()
-    courses = db.execute("SELECT * FROM courses").fetchall()
-    results = db.execute('''SELECT r.*, u.name, u.department, c.title_vi, c.title_en, c.category
-        FROM results r LEFT JOIN users u ON r.user_email=u.email LEFT JOIN courses c ON r.course_id=c.id
-        WHERE r.is_valid=1 ORDER BY r.completed_at DESC''').fetchall()
-    dept_stats = {}
-    for dept in DEPARTMENTS:
-        du = [u for u in users_all if u['department']==dept and u['role'] in ('learner','trainer')]
-        dr = [r for r in results if r['department']==dept]
-        dp = [r for r in dr if r['passed']]
-        dept_stats[dept] = {'users':len(du),'attempts':len(dr),'passed':len(dp),
-                            'rate':round(len(dp)/len(dr)*100) if dr else 0}
-    return render_template('analytics.html', user=user, results=results, dept_stats=dept_stats,
-                           users_all=users_all, courses=courses)
+    courses = get_visible_courses(user)
+    learners = db.execute("""SELECT department, team, COUNT(*) AS cnt FROM users
+                             WHERE role IN ('learner','trainer') GROUP BY department, team""").fetchall()
+    dept_users, team_users = {}, {}
+    for r in learners:
+        dept_users[r['department']] = dept_users.get(r['department'], 0) + r['cnt']
+        team_users[r['team']] = team_users.get(r['team'], 0) + r['cnt']
+    by_dept, by_team = get_rollup('department'), get_rollup('team')
+    empty = {'attempts': 0, 'passes': 0, 'certs': 0, 'rate': 0}
+    dept_stats = {d: dict(by_dept.get(d, empty), users=dept_users.get(d, 0)) for d in DEPARTMENTS}
+    team_stats = {t: dict(by_team.get(t, empty), users=team_users.get(t, 0)) for t in TEAMS}
+    since = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    day_stats = sorted(((k, v) for k, v in get_rollup('day').items() if k >= since), reverse=True)
+    return render_template('analytics.html', user=user, dept_stats=dept_stats,
+                           team_stats=team_stats, day_stats=day_stats, course_stats=get_rollup('course'),
+                           courses=courses)
+
+@app.route('/admin/api/results')
+@admin_required
+def api_results():
+    """One page of training history, newest first, using keyset pagination on (completed_at, id)."""
+    where, params = history_filters(request.args)
+    token = request.args.get('cursor', '')
+    cursor = decode_cursor(token)
+    if token and not cursor:
+        return jsonify(error='invalid cursor'), 400
+    if cursor:
+        where += " AND (r.completed_at, r.id) < (?, ?)"; params += list(cursor)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    rows = get_db().execute(f"{HISTORY_SELECT} WHERE {where} ORDER BY r.completed_at DESC, r.id DESC LIMIT ?",
+                            [*params, limit + 1]).fetchall()
+    items = [dict(r) for r in rows[:limit]]
+    return jsonify(items=items, next_cursor=encode_cursor(rows[limit - 1]) if len(rows) > limit else None)
 
 @app.route('/admin/export-csv')
 @admin_required
 def export_csv():
-    results = get_db().execute('''SELECT r.*, u.name, u.department, c.title_vi, c.title_en
-        FROM results r LEFT JOIN users u ON r.user_email=u.email LEFT JOIN courses c ON r.course_id=c.id
-        WHERE r.is_valid=1 ORDER BY r.completed_at DESC''').fetchall()
-    out = io.StringIO(); out.write('\ufeff')
-    w = csv.writer(out)
-    w.writerow(['Name','Email','Department','Course','Score','Total','Passed','Attempt','Date'])
-    for r in results:
-        w.writerow([r['name'],r['user_email'],r['department'],r['title_vi'] or r['title_en'],
-                     r['score'],r['total'],'Yes' if r['passed'] else 'No',r['attempt_number'] or 1,r['completed_at']])
-    out.seek(0)
-    return make_response(out.getvalue(), 200,
-                         {'Content-Type':'text/csv; charset=utf-8',
-                          'Content-Disposition':f'attachment; filename=report_{datetime.now().strftime("%Y%m%d")}.csv'})
+    """Stream valid results as CSV. Accepts the same filters as /admin/api/results."""
+    where, params = history_filters(request.args)
+    cursor = get_db().execute(f"{HISTORY_SELECT} WHERE {where} ORDER BY r.completed_at DESC, r.id DESC", params)
+
+    def generate():
+        out = io.StringIO()
+        w = csv.writer(out)
+        out.write('\ufeff')
+        w.writerow(['Name','Email','Department','Course','Score','Total','Passed','Attempt','Date'])
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            for r in rows:
+                w.writerow([r['name'],r['user_email'],r['department'],r['title_vi'] or r['title_en'],
+                             r['score'],r['total'],'Yes' if r['passed'] else 'No',r['attempt_number'] or 1,r['completed_at']])
+            yield out.getvalue()
+            out.seek(0); out.truncate()
+        yield out.getvalue()
+
+    return Response(stream_with_context(generate()),
+                    headers={'Content-Type':'text/csv; charset=utf-8',
+                             'Content-Disposition':f'attachment; filename=report_{datetime.now().strftime("%Y%m%d")}.csv'})
+
+
+class ZipStream:
+    """Write-only file object for zipfile; the generator drains what has been written so far."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_entry_name(row):
+    """<course>/<certificate file>, without characters that break archive tools."""
+    clean = lambda v: re.sub(r'[\\/:*?"<>|]+', '_', v)
+    return f"{clean(row['title_vi'] or row['title_en'] or str(row['course_id']))}/{clean(certificate_filename(row['name'], row['id']))}"
+
+
+@app.route('/admin/export-certificates')
+@admin_required
+def export_certificates():
+    """Stream a ZIP of the certificates of passed results. Accepts the /admin/api/results filters.
+
+    Missing renders are produced by a thread pool, one batch at a time, and each entry is
+    streamed out as soon as it is written, so neither the archive nor the result set sits in memory.
+    """
+    where, params = history_filters(request.args)
+    cursor = get_db().execute(f"{HISTORY_SELECT} WHERE {where} AND r.passed=1 ORDER BY r.course_id, r.id", params)
+
+    def generate():
+        stream, memo = ZipStream(), {}
+        archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+        with ThreadPoolExecutor(max_workers=CERT_RENDER_WORKERS) as pool:
+            while True:
+                rows = cursor.fetchmany(100)
+                if not rows:
+                    break
+                pending = {}
+                for r in rows:
+                    path = certificate_path(r['id'])
+                    if os.path.exists(path):
+                        archive.write(path, zip_entry_name(r))
+                    else:
+                        data = load_certificate_data(r, r, memo)
+                        pending[pool.submit(write_certificate, data)] = zip_entry_name(r)
+                yield stream.drain()
+                for done in as_completed(pending):
+                    archive.write(done.result(), pending[done])
+                    yield stream.drain()
+        archive.close()
+        yield stream.drain()
+
+    return Response(stream_with_context(generate()),
+                    headers={'Content-Type': 'application/zip',
+                             'Content-Disposition': f'attachment; filename=certificates_{datetime.now().strftime("%Y%m%d")}.zip'})
+
+
+@app.route('/admin/api/results/changes')
+@admin_or_sync_token
+def api_results_changes():
+    """Delta feed for HR sync: results inserted and results invalidated/deleted after `cursor`.
+
+    The cursor is "<last result id>.<last changelog seq>"; start with none (or 0.0)
+    and store `next_cursor` after each run. Repeat while `has_more` is true.
+    `format=csv` returns the same rows as CSV with the cursor in X-Next-Cursor.
+    """
+    try:
+        last_id, last_seq = (int(x) for x in request.args.get('cursor', '0.0').split('.', 1))
+    except ValueError:
+        return jsonify(error='invalid cursor'), 400
+    limit = min(max(request.args.get('limit', 1000, type=int), 1), 5000)
+    db = get_db()
+    inserted = db.execute(f"{HISTORY_SELECT.replace('SELECT r.id,', 'SELECT r.id, r.is_valid,', 1)} "
+                          "WHERE r.id > ? ORDER BY r.id LIMIT ?", (last_id, limit + 1)).fetchall()
+    changes = db.execute("SELECT seq, result_id, change, changed_at FROM results_changelog WHERE seq > ? ORDER BY seq LIMIT ?",
+                         (last_seq, limit + 1)).fetchall()
+    has_more = len(inserted) > limit or len(changes) > limit
+    inserted, changes = inserted[:limit], changes[:limit]
+    next_cursor = f"{inserted[-1]['id'] if inserted else last_id}.{changes[-1]['seq'] if changes else last_seq}"
+
+    if request.args.get('format') == 'csv':
+        out = io.StringIO(); out.write('\ufeff')
+        w = csv.writer(out)
+        w.writerow(['Change','ResultId','Name','Email','Department','Course','Score','Total','Passed','Attempt','Date','Valid','ChangedAt'])
+        for r in inserted:
+            w.writerow(['insert', r['id'], r['name'], r['user_email'], r['department'], r['title_vi'] or r['title_en'],
+                        r['score'], r['total'], 'Yes' if r['passed'] else 'No', r['attempt_number'] or 1,
+                        r['completed_at'], 'Yes' if r['is_valid'] else 'No', r['completed_at']])
+        for ch in changes:
+            w.writerow([ch['change'], ch['result_id']] + [''] * 10 + [ch['changed_at']])
+        return make_response(out.getvalue(), 200,
+                             {'Content-Type': 'text/csv; charset=utf-8', 'X-Next-Cursor': next_cursor,
+                              'X-Has-More': '1' if has_more else '0'})
+    return jsonify(results=[dict(r) for r in inserted],
+                   changes=[dict(ch) for ch in changes],
+                   next_cursor=next_cursor, has_more=has_more)
 
 
 # ═══════════════════ SMTP TEST ═══════════════════
@@ -1209,6 +3277,11 @@ def export_csv():
 @admin_only
 def test_smtp():
     user = get_current_user()
+    state = get_smtp_state()
+    if state['is_open']:
+        flash(f'SMTP đang tạm ngưng sau {state["failures"]} lần lỗi liên tiếp (đến {state["open_until_str"]}). '
+              'Sửa cấu hình rồi bấm "Reset" để thử lại.', 'error')
+        return redirect(url_for('admin_panel') + '#emails')
     ok = send_email(user['email'], '🧪 MANI LMS - SMTP Test',
                     '<h2 style="color:#003047">✅ SMTP hoạt động!</h2><p>Email test từ MANI Learning Hub.</p>')
     flash(f'SMTP {"OK! Kiểm tra hộp thư " + user["email"] if ok else "FAILED. Kiểm tra SMTP_USER & SMTP_PASS trên Render."}',
@@ -1216,6 +3289,246 @@ def test_smtp():
     return redirect(url_for('admin_panel') + '#emails')
 
 
+@app.route('/admin/smtp/reset', methods=['POST'])
+@admin_only
+def reset_smtp_breaker():
+    save_smtp_state(transport='', failures=0, open_until=0)
+    flash('Đã reset trạng thái SMTP.', 'success')
+    return redirect(url_for('admin_panel') + '#emails')
+
+
+
+# ═══════════════════ METRICS ═══════════════════
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target for all worker processes. Needs `Authorization: Bearer <METRICS_TOKEN>`."""
+    if not METRICS_TOKEN:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return Response('unauthorized\n', status=401, mimetype='text/plain', headers={'WWW-Authenticate': 'Bearer'})
+    file_size = lambda path: os.path.getsize(path) if os.path.exists(path) else 0
+    last_minute = get_db().execute(
+        "SELECT COUNT(*) FROM results WHERE completed_at >= datetime('now', '-60 seconds')").fetchone()[0]
+    gauges = [
+        ('lms_db_size_bytes', 'SQLite database file size.', file_size(DATABASE)),
+        ('lms_db_wal_size_bytes', 'SQLite write-ahead log size.', file_size(DATABASE + '-wal')),
+        ('lms_quiz_submissions_last_minute', 'Results recorded in the last 60 seconds.', last_minute),
+    ]
+    return Response(render_metrics(*collect_metrics(), gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ═══════════════════ SYNTHETIC DATA & BENCHMARK ═══════════════════
+SYNTHETIC_DOMAIN = 'synthetic.mani.test'
+SYNTHETIC_PASSWORD = 'bench1234'
+SYNTHETIC_WORDS = ('an toàn', 'quy trình', 'sản phẩm', 'kháng khuẩn', 'vô trùng', 'kim khâu', 'dao mổ',
+                   'nha khoa', 'tồn kho', 'hóa đơn', 'khách hàng', 'bảo quản', 'tiệt trùng', 'phẫu thuật',
+                   'hướng dẫn', 'kiểm soát', 'chất lượng', 'báo cáo', 'đào tạo', 'tuân thủ')
+
+
+def synthetic_phrase(rnd, n):
+    return ' '.join(rnd.choice(SYNTHETIC_WORDS) for _ in range(n)).capitalize()
+
+
+@app.cli.command('seed-data')
+@click.option('--users', default=5000, show_default=True)
+@click.option('--courses', default=500, show_default=True)
+@click.option('--questions', default=20, show_default=True, help='Questions per course.')
+@click.option('--results', default=1_000_000, show_default=True)
+@click.option('--retests', default=200, show_default=True)
+@click.option('--seed', default=42, show_default=True, help='Same seed, same dataset.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def seed_data_command(users, courses, questions, results, retests, seed, yes):
+    """Fill the database with a reproducible synthetic dataset (for benchmarks, never production)."""
+    if not yes:
+        click.confirm(f'Insert {users} users, {courses} courses and {results} results into {DATABASE}?', abort=True)
+    rnd = random.Random(seed)
+    db = get_db()
+    started = time.perf_counter()
+    now = datetime.now()
+    pw = hash_password(SYNTHETIC_PASSWORD)
+    people = [(f'user{i:05d}@{SYNTHETIC_DOMAIN}', f'Nhân viên {i:05d}', rnd.choice(DEPARTMENTS), rnd.choice(TEAMS),
+               rnd.choice(JOB_TITLES), rnd.choice(JOB_LEVELS)) for i in range(users)]
+    db.executemany("INSERT OR IGNORE INTO allowed_emails (email,note,added_by) VALUES (?,'synthetic','seed-data')",
+                   [(p[0],) for p in people])
+    db.executemany("""INSERT OR IGNORE INTO users (email,password_hash,name,department,team,job_title,job_level,role,verified,status)
+                      VALUES (?,?,?,?,?,?,?,'learner',1,'active')""",
+                   [(e, pw, n, d, t, jt, jl) for e, n, d, t, jt, jl in people])
+    # Ids come from each INSERT: courses is AUTOINCREMENT, so MAX(id)+1 is wrong once a course was deleted.
+    course_ids, targets = [], []
+    for _ in range(courses):
+        depts = rnd.sample(DEPARTMENTS, rnd.randint(1, len(DEPARTMENTS)))
+        cid = db.execute("""INSERT INTO courses (title_vi,desc_vi,category,target_groups,pass_score,quiz_count,max_attempts,created_by,created_at)
+                            VALUES (?,?,?,?,?,?,?,?,?)""",
+                         (synthetic_phrase(rnd, 3), synthetic_phrase(rnd, 12), rnd.choice(CATEGORIES),
+                          json.dumps(depts), rnd.randint(3, 8), 10, 3, f'user00000@{SYNTHETIC_DOMAIN}',
+                          (now - timedelta(days=rnd.randint(0, 720))).strftime('%Y-%m-%d %H:%M:%S'))).lastrowid
+        course_ids.append(cid)
+        targets += [(cid, 'department', d) for d in depts]
+    db.executemany("INSERT OR IGNORE INTO course_targets (course_id,target_type,value) VALUES (?,?,?)", targets)
+    db.executemany(QUESTION_INSERT, (
+        (cid, f'{synthetic_phrase(rnd, 8)}?', *(synthetic_phrase(rnd, 3) for _ in range(4)),
+         rnd.choice('abcd'), synthetic_phrase(rnd, 6), 'synthetic')
+        for cid in course_ids for _ in range(questions)))
+    user_by_email = {p[0]: p for p in people}
+    emails = list(user_by_email)
+
+    def result_rows():
+        for _ in range(results):
+            email = rnd.choice(emails)
+            score = rnd.randint(0, 10)
+            done = now - timedelta(minutes=rnd.randint(0, 365 * 24 * 60))
+            yield (email, rnd.choice(course_ids), score, 10, int(score >= 5), '{}', rnd.randint(1, 3),
+                   done.strftime('%Y-%m-%d %H:%M:%S'), user_by_email[email][2], user_by_email[email][3])
+
+    db.executemany("""INSERT INTO results (user_email,course_id,score,total,passed,answers_json,attempt_number,completed_at,department,team)
+                      VALUES (?,?,?,?,?,?,?,?,?,?)""", result_rows())
+    db.executemany("INSERT INTO retest_requests (course_id,target_type,target_value,requested_by,deadline) VALUES (?,?,?,?,?)",
+                   [(rnd.choice(course_ids), 'department', rnd.choice(DEPARTMENTS), 'seed-data',
+                     (now + timedelta(days=14)).strftime('%Y-%m-%d')) for _ in range(retests)])
+    db.commit()
+    db.execute("ANALYZE")
+    print(f"[SEED] {users} users, {courses} courses, {courses * questions} questions, {results} results, "
+          f"{retests} retests in {time.perf_counter() - started:.1f}s (password: {SYNTHETIC_PASSWORD})")
+
+
+class BenchClient:
+    """Issues requests through the Flask test client, or over HTTP when base_url is set.
+
+    Redirects are never followed, so every request is timed on its own.
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        if base_url:
+            import http.cookiejar
+            import urllib.request
+
+            class NoRedirect(urllib.request.HTTPRedirectHandler):
+                def redirect_request(self, *args, **kwargs):
+                    return None
+
+            self.opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect())
+        else:
+            self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        """(status, Location header, body size) for one request; the body is fully read."""
+        if not self.base_url:
+            # A fresh app context per request: the CLI keeps one pushed, and a request
+            # context would otherwise reuse it and carry g.user over between sessions.
+            with app.app_context():
+                r = self.client.open(path, method=method, data=data)
+                return r.status_code, r.headers.get('Location', ''), len(r.get_data())
+        import urllib.error
+        import urllib.parse
+        import urllib.request
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as r:
+                return r.status, r.headers.get('Location', ''), len(r.read())
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('Location', ''), len(e.read())
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))]
+
+
+@app.cli.command('benchmark')
+@click.option('--iterations', default=50, show_default=True, help='Learner sessions to run.')
+@click.option('--url', default=None, help='Base URL of a running server (default: in-process test client).')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--admin-email', default='mmh.product@manimedicalhanoi.com', show_default=True)
+@click.option('--admin-password', default='123456', show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report here instead of stdout.')
+def benchmark_command(iterations, url, seed, admin_email, admin_password, output):
+    """Drive the real routes and report p50/p95/p99 latency and throughput per route as JSON.
+
+    Run `flask seed-data` first. Each iteration logs in as a different synthetic learner,
+    opens the dashboard, searches, takes and submits a quiz and opens its result; the admin
+    session loads analytics and a 30-day CSV export. Quiz submissions write real results.
+    """
+    rnd = random.Random(seed)
+    with app.app_context():
+        db = get_db()
+        learners = [r['email'] for r in db.execute(
+            "SELECT email FROM users WHERE email LIKE ? ORDER BY email", (f'%@{SYNTHETIC_DOMAIN}',)).fetchall()]
+        dataset = {t: db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                   for t in ('users', 'courses', 'questions', 'results', 'retest_requests')}
+    if not learners:
+        raise click.ClickException('No synthetic users found; run `flask seed-data` first.')
+    timings, errors = {}, {}
+
+    def timed(name, client, method, path, data=None, expect=(200,)):
+        t0 = time.perf_counter()
+        status, location, _ = client.request(method, path, data)
+        timings.setdefault(name, []).append(time.perf_counter() - t0)
+        if status not in expect:
+            errors[name] = errors.get(name, 0) + 1
+        return status, location
+
+    def run_sessions():
+        for _ in range(iterations):
+            email = learners[rnd.randrange(len(learners))]
+            client = BenchClient(url)
+            timed('login', client, 'POST', '/login', {'email': email, 'password': SYNTHETIC_PASSWORD}, expect=(302,))
+            timed('dashboard', client, 'GET', '/dashboard')
+            timed('search', client, 'GET', '/search?' + urlencode({'q': rnd.choice(SYNTHETIC_WORDS).split()[0]}))
+            with app.test_request_context():
+                open_courses = [e['course_id'] for e in get_eligibility(email) if e['can_take']]
+                cid = rnd.choice(open_courses) if open_courses else None
+                bank = [q['id'] for q in get_question_bank(cid)] if cid else []
+            if not bank:
+                continue
+            timed('quiz', client, 'GET', f'/quiz/{cid}')
+            picked = rnd.sample(bank, min(10, len(bank)))
+            form = {'question_ids': ','.join(map(str, picked)), **{f'q_{q}': rnd.choice('abcd') for q in picked}}
+            status, location = timed('quiz_submit', client, 'POST', f'/quiz/{cid}', form, expect=(302,))
+            if location:
+                parts = urlsplit(location)
+                timed('quiz_result', client, 'GET', parts.path + (f'?{parts.query}' if parts.query else ''))
+        admin = BenchClient(url)
+        timed('admin_login', admin, 'POST', '/login', {'email': admin_email, 'password': admin_password}, expect=(302,))
+        since = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        for _ in range(max(iterations // 5, 1)):
+            timed('analytics', admin, 'GET', '/admin/analytics')
+            timed('analytics_api', admin, 'GET', '/admin/api/results')
+            timed('export_csv', admin, 'GET', f'/admin/export-csv?date_from={since}')
+
+    started = time.perf_counter()
+    # App logging ([EMAIL-SKIP] etc.) goes to stderr so stdout stays valid JSON.
+    with contextlib.redirect_stdout(sys.stderr):
+        run_sessions()
+    wall = time.perf_counter() - started
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    routes = {}
+    for name, values in timings.items():
+        values = sorted(values)
+        routes[name] = {
+            'count': len(values), 'errors': errors.get(name, 0),
+            'p50_ms': round(percentile(values, 50) * 1000, 2), 'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2), 'mean_ms': round(sum(values) / len(values) * 1000, 2),
+            'rps': round(len(values) / sum(values), 1) if sum(values) else None,
+        }
+    report = {'commit': commit, 'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'target': url or 'test-client', 'iterations': iterations, 'seed': seed, 'dataset': dataset,
+              'wall_seconds': round(wall, 2), 'routes': routes}
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        print(f"[BENCH] report written to {output}")
+    else:
+        print(text)
+
 # ═══════════════════ INIT ═══════════════════
 with app.app_context():
     init_db()
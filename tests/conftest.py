@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its paths and migrates the database at import time, so point everything at a
+# throwaway directory before the first `import app`.
+TMP_DIR = tempfile.mkdtemp(prefix='mani-lms-test-')
+os.environ['DATABASE_PATH'] = os.path.join(TMP_DIR, 'lms.db')
+os.environ['AVATAR_UPLOAD_FOLDER'] = os.path.join(TMP_DIR, 'avatars')
+os.environ['CERT_CACHE_DIR'] = os.path.join(TMP_DIR, 'certs')
+os.environ['METRICS_DIR'] = os.path.join(TMP_DIR, 'metrics')
+os.environ.pop('SMTP_USER', None)
+os.environ.pop('SMTP_PASS', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lms  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def seeded():
+    """A small synthetic dataset in the temp database; user00001 is promoted to admin."""
+    result = lms.app.test_cli_runner().invoke(args=[
+        'seed-data', '--users', '40', '--courses', '12', '--questions', '8',
+        '--results', '600', '--retests', '4', '--yes'])
+    assert result.exit_code == 0, result.output
+    admin = f'user00001@{lms.SYNTHETIC_DOMAIN}'
+    with lms.app.app_context():
+        db = lms.get_db()
+        db.execute("UPDATE users SET role='admin' WHERE email=?", (admin,))
+        db.commit()
+    return {'admin': admin}
+
+
+@pytest.fixture(scope='session')
+def login(seeded):
+    """login(email) -> a test client with that user's session."""
+    def login(email):
+        client = lms.app.test_client()
+        response = client.post('/login', data={'email': email, 'password': lms.SYNTHETIC_PASSWORD})
+        assert response.status_code == 302, f'login as {email} failed'
+        return client
+    return login
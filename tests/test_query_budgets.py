@@ -0,0 +1,79 @@
+"""SQL statement budgets per route.
+
+None of the budgets depends on how many courses, questions or results exist, so a route that
+goes over has grown a per-row (N+1) query. Every request starts with an empty content cache,
+so the budgets are for the cold path. quiz_submit answers everything correctly on a course
+with an open retest request, which is its most expensive path (invalidate, insert, certificate).
+"""
+import pytest
+
+import app as lms
+
+QUERY_BUDGETS = [
+    # (name, session, method, path, max statements)
+    ('dashboard', 'learner', 'GET', '/dashboard', 4),
+    ('category', 'learner', 'GET', '/category/SOP', 4),
+    ('search', 'learner', 'GET', '/search?q=an', 3),
+    ('course_detail', 'learner', 'GET', '/course/{cid}', 5),
+    ('quiz', 'learner', 'GET', '/quiz/{cid}', 6),
+    ('quiz_result', 'learner', 'GET', '/quiz-result/{rcid}/{rid}', 7),
+    ('certificate', 'learner', 'GET', '/certificate/{rcid}/{rid}', 5),
+    ('my_certs', 'learner', 'GET', '/my-certs', 2),
+    ('profile', 'learner', 'GET', '/profile', 1),
+    ('quiz_submit', 'learner', 'POST', '/quiz/{cid}', 14),
+    ('admin', 'admin', 'GET', '/admin', 8),
+    ('questions', 'admin', 'GET', '/admin/course/{cid}/questions', 4),
+    ('analytics', 'admin', 'GET', '/admin/analytics', 8),
+    ('analytics_api', 'admin', 'GET', '/admin/api/results', 2),
+    ('export_csv', 'admin', 'GET', '/admin/export-csv', 2),
+]
+
+
+@pytest.fixture(scope='module')
+def sessions(seeded, login):
+    """Logged-in clients plus the ids the budgeted paths refer to."""
+    with lms.app.app_context():
+        db = lms.get_db()
+        learner, rcid, rid = db.execute(
+            """SELECT user_email, course_id, id FROM results
+               WHERE user_email LIKE ? AND user_email != ? AND passed=1 AND is_valid=1
+               ORDER BY id LIMIT 1""", (f'%@{lms.SYNTHETIC_DOMAIN}', seeded['admin'])).fetchone()
+        cid = next(e['course_id'] for e in lms.get_eligibility(learner) if e['can_take'])
+        user = db.execute("SELECT department FROM users WHERE email=?", (learner,)).fetchone()
+        db.execute("""INSERT INTO retest_requests (course_id,target_type,target_value,requested_by,deadline)
+                      VALUES (?,'department',?,'tests','2999-12-31')""", (cid, user['department']))
+        db.commit()
+        bank = lms.get_question_bank(cid)
+    return {
+        'clients': {'learner': login(learner), 'admin': login(seeded['admin'])},
+        'ids': {'cid': cid, 'rcid': rcid, 'rid': rid},
+        'quiz_form': {'question_ids': ','.join(str(q['id']) for q in bank),
+                      **{f"q_{q['id']}": q['answer'] for q in bank}},
+    }
+
+
+@pytest.fixture
+def traced():
+    previous = lms.app.config['SQL_TRACE']
+    lms.app.config['SQL_TRACE'] = True
+    yield
+    lms.app.config['SQL_TRACE'] = previous
+
+
+def traced_request(client, method, path, data=None):
+    """(status, [[sql, seconds], ...]) for one request, starting from a cold content cache."""
+    lms.CONTENT_CACHE.sync(object())
+    # The request reuses this app context, so its connection (and trace) is still in g afterwards.
+    with lms.app.app_context():
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        return response.status_code, list(getattr(lms.g.get('db'), 'statements', ()))
+
+
+@pytest.mark.parametrize('name, who, method, path, budget', QUERY_BUDGETS, ids=[b[0] for b in QUERY_BUDGETS])
+def test_query_budget(sessions, traced, name, who, method, path, budget):
+    status, statements = traced_request(sessions['clients'][who], method, path.format(**sessions['ids']),
+                                         sessions['quiz_form'] if method == 'POST' else None)
+    assert status == (302 if method == 'POST' else 200)
+    listing = '\n'.join(f"  {seconds * 1000:6.2f} ms  {' '.join(sql.split())}" for sql, seconds in statements)
+    assert len(statements) <= budget, f'{name} ran {len(statements)} statements (budget {budget}):\n{listing}'